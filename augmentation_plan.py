@@ -0,0 +1,77 @@
+from pathlib import Path
+
+import numpy as np
+
+import data_vectorizer
+
+
+class AugmentationPlan:
+    # Tabelle (Aufnahme, Randomisierung, (Rotation, dx, dy)) relativ zur
+    # Standard-Geometrie. Jede Zeile hängt nur vom Seed und ihrem Index ab,
+    # die Vektoren können so in beliebiger Reihenfolge und Aufteilung
+    # extrahiert werden und sind trotzdem immer gleich.
+
+    geometries: np.ndarray
+    seed: int
+    max_offset: int
+    max_rotation: float
+    centered: bool
+
+    def __init__(self, geometries: np.ndarray, seed: int, max_offset: int = 4, max_rotation: float = 10,
+                 centered: bool = False) -> None:
+        self.geometries = geometries
+        self.seed = seed
+        self.max_offset = max_offset
+        self.max_rotation = max_rotation
+        self.centered = centered
+
+
+    @property
+    def n_recordings(self):
+        return self.geometries.shape[0]
+
+
+    @property
+    def n_randomizations(self):
+        return self.geometries.shape[1]
+
+
+    def get_geometries(self, recording: int, indices=None):
+        if indices is None:
+            return self.geometries[recording]
+        return self.geometries[recording, indices]
+
+
+    def get_params(self):
+        return {
+            "seed": self.seed,
+            "n_randomizations": self.n_randomizations,
+            "max_offset": self.max_offset,
+            "max_rotation": self.max_rotation,
+            "centered": self.centered,
+        }
+
+
+    def save(self, filepath: Path):
+        np.savez(filepath, geometries=self.geometries, seed=self.seed,
+                 max_offset=self.max_offset, max_rotation=self.max_rotation, centered=self.centered)
+
+
+def load(filepath: Path):
+    with np.load(filepath) as data:
+        # Ältere Pläne wurden immer mit der einseitigen Formel gezogen
+        centered = bool(data["centered"]) if "centered" in data else False
+        return AugmentationPlan(data["geometries"], int(data["seed"]),
+                                int(data["max_offset"]), float(data["max_rotation"]), centered)
+
+
+def make_plan(n_recordings: int, n_randomizations: int, seed: int, max_offset: int = 4, max_rotation: float = 10,
+              centered: bool = False):
+    # Jede Aufnahme zieht aus einem eigenen Strom, die ersten n Zeilen sind
+    # deshalb auch bei einem größeren Plan mit demselben Seed gleich
+    vectorizer = data_vectorizer.Vectorizer(None, None)
+    geometries = np.empty((n_recordings, n_randomizations, 3))
+    for recording, seed_sequence in enumerate(np.random.SeedSequence(seed).spawn(n_recordings)):
+        geometries[recording] = vectorizer.get_random_geometries(
+            n_randomizations, max_offset, max_rotation, rng=np.random.default_rng(seed_sequence), centered=centered)
+    return AugmentationPlan(geometries, seed, max_offset, max_rotation, centered)
@@ -0,0 +1,246 @@
+import argparse
+import json
+import platform
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import h5py
+import numpy as np
+
+import data_preparer
+import data_reader
+import data_vectorizer
+
+SCALES = {
+    "small": {"recordings": 2, "frames": 1000},
+    "medium": {"recordings": 4, "frames": 4000},
+    "large": {"recordings": 8, "frames": 8000},
+}
+LETTERS = ["A", "E", "O"]
+SEGMENT_SPACING_SECONDS = 1.0
+BATCH_SIZE = 32
+# Ohne /proc (z.B. macOS) wird immer tracemalloc verwendet
+TRACE_ALLOCATIONS = False
+
+
+def get_memory_mb():
+    # Aktuelles RSS und dessen Höchststand (VmRSS, VmHWM), None ohne /proc
+    status_path = Path("/proc/self/status")
+    if not status_path.exists():
+        return None
+    status = dict(line.split(":", 1) for line in status_path.read_text().splitlines())
+    return tuple(int(status[key].split()[0]) / 1024 for key in ("VmRSS", "VmHWM"))
+
+
+def reset_peak_rss():
+    # Setzt unter Linux VmHWM auf das aktuelle RSS zurück, damit jede Stufe
+    # nur ihren eigenen Höchststand misst und nicht den früherer Stufen
+    try:
+        Path("/proc/self/clear_refs").write_text("5")
+    except OSError:
+        return False
+    return get_memory_mb() is not None
+
+
+def make_synthetic_data(folder: Path, recordings: int, frames: int, seed: int = 0):
+    # Legt die Struktur von data/sub001 mit zufälligen Recon-Dateien an
+    rng = np.random.default_rng(seed)
+    timestamps_folder = folder / "timestamps"
+    recon_folder = folder / "2drt" / "recon"
+    timestamps_folder.mkdir(parents=True, exist_ok=True)
+    recon_folder.mkdir(parents=True, exist_ok=True)
+
+    size = data_vectorizer.Vectorizer.IMAGE_SIZE
+    duration = frames * data_reader.FRAME_DURATION
+    mapper = ["csv,h5"]
+    for idx in range(recordings):
+        name = f"sub001_2drt_{idx + 1:02d}_vcv{idx + 1}_r1_recon"
+        with h5py.File(recon_folder / f"{name}.h5", "w") as file:
+            file.create_dataset("recon", data=rng.random((frames, size, size), dtype=np.float32))
+
+        lines = ["Buchstabe;Buchstabenr.;Timestamp start;Timestamp ende"]
+        starts = np.arange(0.5, duration - 1, SEGMENT_SPACING_SECONDS)
+        for number, start in enumerate(starts):
+            end = start + rng.uniform(0.2, 0.6)
+            lines.append(f"{LETTERS[number % len(LETTERS)]};{number // len(LETTERS) + 1};{start:.3f};{end:.3f}")
+        (timestamps_folder / f"{name}.csv").write_text("\n".join(lines))
+        mapper.append(f"{name}.csv,{name}.h5")
+
+    (timestamps_folder / "mapper.csv").write_text("\n".join(mapper))
+    return folder
+
+
+def measure(results: list, scale: str, stage: str, function, samples_of=len):
+    # stage_peak_mb ist der zusätzliche Speicher der Stufe auf ihrem Höchststand.
+    # Über das RSS zählen nur neu belegte Seiten, Speicher, den der Allokator
+    # von früheren Stufen wiederverwendet, nicht. tracemalloc zählt alle
+    # Allokationen, bremst reine Python-Stufen aber auf das Zwei- bis Dreifache.
+    per_stage_rss = not TRACE_ALLOCATIONS and reset_peak_rss()
+    if per_stage_rss:
+        rss_before, _ = get_memory_mb()
+    else:
+        tracemalloc.start()
+    start = time.perf_counter()
+    value = function()
+    seconds = time.perf_counter() - start
+    if per_stage_rss:
+        _, peak_rss = get_memory_mb()
+        stage_peak = peak_rss - rss_before
+    else:
+        peak_rss = None
+        stage_peak = tracemalloc.get_traced_memory()[1] / 1024**2
+        tracemalloc.stop()
+    samples = samples_of(value)
+    results.append({
+        "scale": scale,
+        "stage": stage,
+        "seconds": seconds,
+        "samples": samples,
+        "samples_per_second": samples / seconds if seconds > 0 else None,
+        "peak_rss_mb": peak_rss,
+        "stage_peak_mb": stage_peak,
+    })
+    print(f"{scale:>8} {stage:<28} {seconds*1000:10.1f} ms {samples:8d} samples {stage_peak:8.1f} MiB")
+    return value
+
+
+def run_scale(results: list, scale: str, n_randomizations: int, model_path: Path = None):
+    mapper = data_reader.get_mapper()
+    data_preparer.close_vectorizers()
+    # Damit der erste Durchlauf wirklich die CSV-Dateien parst, auch bei
+    # echten Daten. Er legt die Segment-Tabellen gleich wieder an.
+    for _, row in mapper.iterrows():
+        data_reader.get_segment_table_path(data_reader.get_timestamps_path(row["csv"])).unlink(missing_ok=True)
+
+    recons = measure(results, scale, "get_recon", lambda: [
+        data_reader.get_recon(row["h5"]) for _, row in mapper.iterrows()
+    ], lambda recons: sum(len(recon) for recon in recons))
+    # Beim zweiten Lesen werden die gespeicherten Segment-Tabellen verwendet
+    for stage in ["get_timestamps (cold)", "get_timestamps (warm)"]:
+        timestamps = measure(results, scale, stage, lambda: [
+            data_reader.get_timestamps(row["csv"]) for _, row in mapper.iterrows()
+        ], lambda timestamps: sum(len(table) for table in timestamps))
+
+    vectorizers = [
+        data_vectorizer.Vectorizer(recon, table, seed=0)
+        for recon, table in zip(recons, timestamps)
+    ]
+    vectors = measure(results, scale, "get_randomized_vectors", lambda: [
+        vector
+        for vectorizer in vectorizers
+        for _ in range(n_randomizations)
+        for vector in vectorizer.get_randomized_vectors()[0]
+    ])
+    vectors = measure(results, scale, "get_randomized_vectors_batch", lambda: [
+        vector
+        for vectorizer in vectorizers
+        for vector in vectorizer.get_randomized_vectors_batch(n_randomizations)[0]
+    ])
+    del recons, vectorizers
+
+    length = max(vector.shape[-1] for vector in vectors)
+    inputs = measure(results, scale, "make_numpy", lambda: data_preparer.make_numpy(vectors, length))
+    ragged = measure(results, scale, "make_ragged", lambda: data_preparer.make_ragged(vectors))
+    batches = data_preparer.make_buckets(ragged.lengths, BATCH_SIZE, seed=0)
+    measure(results, scale, "pad bucketed batches", lambda: [ragged.pad(batch) for batch in batches],
+            lambda padded: sum(len(batch) for batch in padded))
+    padding = data_preparer.get_padding_report(ragged.lengths, BATCH_SIZE, length=length, seed=0)
+    print(f"{scale:>8} {'padding ratio':<28} {padding['padding_fixed']*100:9.1f} % fixed "
+          f"{padding['padding_bucketed']*100:5.1f} % bucketed")
+    del ragged
+
+    if model_path is not None:
+        import inference
+        predictor = inference.Predictor(model_path)
+        segments = [vector[..., :predictor.length] for vector in vectors]
+        measure(results, scale, "predict_batch", lambda: predictor.predict_batch(segments))
+    del inputs
+    return padding
+
+
+def make_model(folder: Path, length: int):
+    # Kleines, untrainiertes LSTM mit dem Eingabeformat aus make_numpy
+    import tensorflow
+    keras = tensorflow.keras
+    vector_count = data_vectorizer.Vectorizer.VECTOR_COUNT
+    vector_length = data_vectorizer.Vectorizer.VECTOR_LENGTH
+    model = keras.Sequential([
+        keras.Input((vector_count, vector_length * length)),
+        keras.layers.LSTM(20),
+        keras.layers.Dense(10, activation="sigmoid"),
+        keras.layers.Dense(len(LETTERS), activation="sigmoid"),
+    ])
+    model_path = folder / "model.keras"
+    model.save(model_path)
+    return model_path
+
+
+def compare(results: list, previous_file: Path):
+    previous = {
+        (entry["scale"], entry["stage"]): entry
+        for entry in json.loads(Path(previous_file).read_text())["results"]
+    }
+    print(f"\nCompared with {previous_file}:")
+    for entry in results:
+        old = previous.get((entry["scale"], entry["stage"]))
+        if old is None or not old["seconds"]:
+            continue
+        ratio = entry["seconds"] / old["seconds"]
+        print(f"{entry['scale']:>8} {entry['stage']:<28} {ratio:6.2f}x time")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the data pipeline and the inference path")
+    parser.add_argument("--scales", nargs="+", default=["small", "medium"], choices=list(SCALES))
+    parser.add_argument("--randomizations", type=int, default=10)
+    parser.add_argument("--real", action="store_true", help=f"use the recordings in {data_reader.BASE_FOLDER}")
+    parser.add_argument("--model", type=Path, help="saved model for the prediction stage")
+    parser.add_argument("--no-model", action="store_true", help="skip the prediction stage")
+    parser.add_argument("--output", type=Path, default=Path("bench_output.json"))
+    parser.add_argument("--compare", type=Path, help="previous JSON output to compare with")
+    parser.add_argument("--tracemalloc", action="store_true",
+                        help="measure stage memory with tracemalloc instead of the RSS, slows down the stages")
+    args = parser.parse_args()
+
+    global TRACE_ALLOCATIONS
+    TRACE_ALLOCATIONS = args.tracemalloc
+
+    results = list()
+    padding = dict()
+    with tempfile.TemporaryDirectory() as temp_folder:
+        temp_folder = Path(temp_folder)
+        if args.real:
+            scales = {"real": None}
+        else:
+            scales = {scale: SCALES[scale] for scale in args.scales}
+
+        for scale, config in scales.items():
+            if config is not None:
+                data_reader.BASE_FOLDER = make_synthetic_data(temp_folder / scale, **config)
+            model_path = args.model
+            if model_path is None and not args.no_model:
+                length = data_preparer.get_max_frames()
+                data_preparer.close_vectorizers()
+                model_path = make_model(temp_folder / scale, length)
+            padding[scale] = run_scale(results, scale, args.randomizations, model_path)
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "randomizations": args.randomizations,
+        "memory": "tracemalloc" if TRACE_ALLOCATIONS or not reset_peak_rss() else "rss",
+        "results": results,
+        "padding": padding,
+    }
+    args.output.write_text(json.dumps(report, indent=2))
+    print(f"\nResults written to {args.output}")
+
+    if args.compare is not None:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
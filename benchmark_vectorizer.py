@@ -0,0 +1,137 @@
+import timeit
+
+import numpy as np
+import pandas as pd
+
+from data_vectorizer import Vectorizer
+
+FRAME_COUNT = 2000
+SEGMENT_COUNT = 30
+SEGMENT_LENGTH = 60
+REPEATS = 5
+
+
+def legacy_get_pixel_data(vectorizer: Vectorizer, vector_positions: np.array, first_frame: int, last_frame: int):
+    # Alte Implementierung aus data_vectorizer, dient als Referenz
+    total_frames = last_frame - first_frame
+    frames = vectorizer.frames[first_frame:last_frame]
+
+    vector_count = vectorizer.VECTOR_COUNT
+    vector_length = vectorizer.VECTOR_LENGTH
+
+    vectors = np.ones((vector_count, total_frames, vector_length))
+    for vector_coords, image in zip(vector_positions, vectors):
+        for col, frame in zip(image, frames):
+            xs = [coords[0] for coords in vector_coords]
+            ys = [coords[1] for coords in vector_coords]
+            col[:] = frame[xs, ys]
+
+    vectors = np.rot90(vectors, axes=(1, 2))
+    return vectors
+
+
+def make_vectorizer(seed: int = 0) -> Vectorizer:
+    rng = np.random.default_rng(seed)
+    size = Vectorizer.IMAGE_SIZE
+    frames = rng.random((FRAME_COUNT, size, size), dtype=np.float32)
+    # Gleiche Achsen-Vertauschung wie in data_reader.get_recon
+    frames = np.flip(np.rot90(frames, k=3, axes=(1, 2)), axis=2)
+
+    first_frames = rng.integers(0, FRAME_COUNT - SEGMENT_LENGTH, SEGMENT_COUNT)
+    timestamps = pd.DataFrame({
+        "Buchstabe": rng.choice(list("AEO"), SEGMENT_COUNT),
+        "first_frame": first_frames.astype(float),
+        "last_frame": (first_frames + rng.integers(1, SEGMENT_LENGTH, SEGMENT_COUNT)).astype(float),
+    })
+    return Vectorizer(frames, timestamps)
+
+
+def check_identical(vectorizer: Vectorizer):
+    for max_offset, max_rotation in [(0, 0), (4, 10)]:
+        relative = vectorizer.get_vectors_relative_position(max_rotation)
+        absolute = vectorizer.get_vectors_absolute_position(relative, max_offset)
+        for _, row in vectorizer.timestamps.iterrows():
+            first_frame = int(row["first_frame"])
+            last_frame = int(row["last_frame"])
+            expected = legacy_get_pixel_data(vectorizer, absolute, first_frame, last_frame)
+            actual = vectorizer.get_pixel_data(absolute, first_frame, last_frame)
+            assert expected.shape == actual.shape
+            assert expected.dtype == actual.dtype
+            assert np.array_equal(expected, actual), "get_pixel_data differs from legacy implementation"
+
+    # Segment ragt über das Ende der Aufnahme hinaus
+    first_frame = FRAME_COUNT - 10
+    expected = legacy_get_pixel_data(vectorizer, absolute, first_frame, FRAME_COUNT + 10)
+    actual = vectorizer.get_pixel_data(absolute, first_frame, FRAME_COUNT + 10)
+    assert np.array_equal(expected, actual), "get_pixel_data differs past the end of the recording"
+
+
+def check_batch_identical(vectorizer: Vectorizer, n_randomizations: int = 20):
+    # Erwartet wird die alte Einzelberechnung, get_randomized_vectors geht selbst über den Batch
+    vectorizer.rng = np.random.default_rng(1)
+    expected_vectors = list()
+    expected_letters = list()
+    for _ in range(n_randomizations):
+        relative = vectorizer.get_vectors_relative_position(10)
+        absolute = vectorizer.get_vectors_absolute_position(relative, 4)
+        for _, row in vectorizer.timestamps.iterrows():
+            expected_vectors.append(vectorizer.get_pixel_data(absolute, int(row["first_frame"]), int(row["last_frame"])))
+            expected_letters.append(row["Buchstabe"])
+
+    vectorizer.rng = np.random.default_rng(1)
+    vectors, letters = vectorizer.get_randomized_vectors_batch(n_randomizations)
+    assert letters == expected_letters
+    for expected, actual in zip(expected_vectors, vectors, strict=True):
+        assert np.array_equal(expected, actual), "batched randomization differs from sequential calls"
+
+
+def benchmark(vectorizer: Vectorizer):
+    relative = vectorizer.get_vectors_relative_position(10)
+    absolute = vectorizer.get_vectors_absolute_position(relative, 4)
+    rows = [
+        (int(row["first_frame"]), int(row["last_frame"]))
+        for _, row in vectorizer.timestamps.iterrows()
+    ]
+
+    def run_legacy():
+        for first_frame, last_frame in rows:
+            legacy_get_pixel_data(vectorizer, absolute, first_frame, last_frame)
+
+    def run_vectorized():
+        for first_frame, last_frame in rows:
+            vectorizer.get_pixel_data(absolute, first_frame, last_frame)
+
+    legacy = min(timeit.repeat(run_legacy, number=1, repeat=REPEATS))
+    vectorized = min(timeit.repeat(run_vectorized, number=1, repeat=REPEATS))
+    return legacy, vectorized
+
+
+def benchmark_batch(vectorizer: Vectorizer, n_randomizations: int = 100):
+    def run_sequential():
+        for _ in range(n_randomizations):
+            vectorizer.get_randomized_vectors()
+
+    def run_batch():
+        vectorizer.get_randomized_vectors_batch(n_randomizations)
+
+    sequential = min(timeit.repeat(run_sequential, number=1, repeat=REPEATS))
+    batch = min(timeit.repeat(run_batch, number=1, repeat=REPEATS))
+    return sequential, batch
+
+
+if __name__ == "__main__":
+    vectorizer = make_vectorizer()
+    check_identical(vectorizer)
+    print("Output is bit-identical to the legacy implementation")
+    check_batch_identical(vectorizer)
+    print("Batched randomization is identical to sequential calls")
+
+    legacy, vectorized = benchmark(vectorizer)
+    print(f"legacy:     {legacy*1000:8.2f} ms for {SEGMENT_COUNT} segments")
+    print(f"vectorized: {vectorized*1000:8.2f} ms for {SEGMENT_COUNT} segments")
+    print(f"speedup:    {legacy/vectorized:8.1f}x")
+
+    sequential, batch = benchmark_batch(vectorizer)
+    print(f"sequential: {sequential*1000:8.2f} ms for 100 randomizations")
+    print(f"batch:      {batch*1000:8.2f} ms for 100 randomizations")
+    print(f"speedup:    {sequential/batch:8.1f}x")
@@ -0,0 +1,65 @@
+import numpy as np
+
+import data_vectorizer
+import instrumentation
+
+CHUNK_FRAMES = 1024
+SEARCH_OFFSET = 8
+SEARCH_ROTATION = 30
+ROTATION_STEP = 2
+# Pixel, die im Mittelbild dunkler sind, liegen außerhalb des Körpers
+BACKGROUND_LEVEL = 0.05
+
+
+def get_temporal_statistics(frames, chunk_frames: int = CHUNK_FRAMES):
+    # Mittelwert und Varianz jedes Pixels über alle Frames. frames ist ein
+    # ndarray oder ReconHandle im Layout von data_reader.get_recon, gelesen
+    # wird blockweise, damit nie die ganze Aufnahme im Speicher liegt.
+    total = np.zeros(frames.shape[1:])
+    squares = np.zeros(frames.shape[1:])
+    with instrumentation.stage("temporal statistics", frames=len(frames)):
+        for start in range(0, len(frames), chunk_frames):
+            chunk = np.asarray(frames[start:start + chunk_frames], dtype=np.float64)
+            total += chunk.sum(axis=0)
+            squares += np.einsum("tij,tij->ij", chunk, chunk)
+    mean = total / len(frames)
+    variance = np.maximum(squares / len(frames) - mean**2, 0)
+    return mean, variance
+
+
+def estimate_geometry(mean: np.ndarray, variance: np.ndarray, search_offset: int = SEARCH_OFFSET,
+                      search_rotation: float = SEARCH_ROTATION, rotation_step: float = ROTATION_STEP):
+    # Der Fächer soll über den bewegten Kanten des Vokaltrakts liegen, die die
+    # größte zeitliche Varianz haben. Alle Kandidaten um die Standard-Geometrie
+    # werden in einem Schritt abgetastet und der mit der größten Summe gewinnt.
+    vectorizer = data_vectorizer.Vectorizer(None, None)
+    score_image = np.sqrt(variance) * (mean > BACKGROUND_LEVEL * mean.max())
+
+    offsets = np.arange(-search_offset, search_offset + 1)
+    rotations = np.arange(-search_rotation, search_rotation + rotation_step / 2, rotation_step)
+    rotations, x_offsets, y_offsets = (
+        grid.ravel() for grid in np.meshgrid(rotations, offsets, offsets, indexing="ij")
+    )
+    rotations = vectorizer.ROTATION_OFFSET_DEGREES + rotations
+    x_offsets = vectorizer.X_OFFSET + x_offsets
+    y_offsets = vectorizer.Y_OFFSET + y_offsets
+    positions = vectorizer.get_vectors_positions(rotations, x_offsets, y_offsets)
+
+    # Geometrien, die aus dem Bild ragen, kommen nicht in Frage
+    inside = ((positions >= 0) & (positions < score_image.shape)).all(axis=(1, 2, 3))
+    positions = np.clip(positions, 0, np.array(score_image.shape) - 1)
+    scores = score_image[positions[..., 0], positions[..., 1]].sum(axis=(1, 2))
+    scores[~inside] = -np.inf
+
+    best = int(np.argmax(scores))
+    return {
+        "x_offset": int(x_offsets[best]),
+        "y_offset": int(y_offsets[best]),
+        "rotation_offset": float(rotations[best]),
+        "score": float(scores[best]),
+    }
+
+
+def calibrate(frames, **kwargs):
+    mean, variance = get_temporal_statistics(frames)
+    return estimate_geometry(mean, variance, **kwargs)
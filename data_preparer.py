@@ -1,36 +1,268 @@
+import augmentation_plan
 import data_reader
 import data_vectorizer
+import dataset_index
+
+import feature_cache
+import instrumentation
+import shared_dataset
 
 import pandas as pd
 import numpy as np
 import tensorflow
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+LOADER_WORKERS = 4
+RANDOMIZATION_CHUNK_SIZE = 10
+SHUFFLE_BUFFER = 1024
 
 vectorizers: list[data_vectorizer.Vectorizer] = None
-def __get_vectorizers():
-    global vectorizers
+sources: list[tuple[Path, Path]] = None
+shared: shared_dataset.SharedDataset = None
+# Argumente für Vectorizer.set_extraction, siehe set_extraction
+extraction: dict = dict()
+def __get_vectorizers(workers: int = LOADER_WORKERS):
+    global vectorizers, sources
     if vectorizers is None:
         mapper = data_reader.get_mapper()
-        vectorizers = list()
-        for idx, row in mapper.iterrows():
-            frames = data_reader.get_recon(row["h5"])
-            timestamps = data_reader.get_timestamps(row["csv"])
-            vectorizers.append(
-                data_vectorizer.Vectorizer(frames, timestamps)
-            )
+        rows = [row for idx, row in mapper.iterrows()]
+        load = partial(__load_vectorizer, calibrations=__get_calibrations())
+        # Lesen und Entpacken ist I/O-lastig, map behält die Reihenfolge des Mappers bei
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            loaded = list(executor.map(load, rows))
+        vectorizers = [vectorizer for vectorizer, _ in loaded]
+        sources = [source for _, source in loaded]
     return vectorizers
 
-def get_randomized_vectors(n_randomizations):
+def get_vectorizers(workers: int = LOADER_WORKERS):
+    # Die geladenen oder mit select_recordings ausgewählten Aufnahmen,
+    # workers gilt nur, wenn sie dafür erst geladen werden
+    return __get_vectorizers(workers)
+
+def __get_calibrations():
+    # Kalibrierte Geometrien aus dem Manifest nach Name der H5-Datei. Ein fehlendes
+    # Manifest wird hier nicht gebaut, die Aufnahmen behalten dann die Standardwerte.
+    manifest_file = data_reader.BASE_FOLDER.parent / dataset_index.MANIFEST_FILE.name
+    if not manifest_file.exists():
+        return dict()
+    index = dataset_index.DatasetIndex.load(manifest_file)
+    return {recording.h5.name: recording.get_geometry() for recording in index.query()}
+
+def __load_vectorizer(row: pd.Series, calibrations: dict):
+    frames = data_reader.open_recon(row["h5"])
+    timestamps = data_reader.get_timestamps(row["csv"])
+    source = (data_reader.get_recon_path(row["h5"]), data_reader.get_timestamps_path(row["csv"]))
+    geometry = calibrations.get(Path(row["h5"]).name, dict())
+    return data_vectorizer.Vectorizer(frames, timestamps, **geometry, **extraction), source
+
+def select_recordings(subject: str = None, letter: str = None, run: str = None,
+                      index: dataset_index.DatasetIndex = None, workers: int = LOADER_WORKERS):
+    # Ersetzt die Aufnahmen aus mapper.csv durch eine Auswahl aus dem Datensatz-Index
+    global vectorizers, sources
+    if index is None:
+        index = dataset_index.get_index()
+    recordings = index.query(subject=subject, letter=letter, run=run)
+
+    close_vectorizers()
+    # Wie in __get_vectorizers öffnet ein Thread-Pool die H5-Dateien
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        vectorizers = list(executor.map(partial(__open_recording, letter=letter), recordings))
+    sources = [(recording.h5, recording.timestamps) for recording in recordings]
+    return recordings
+
+def __open_recording(recording: dataset_index.Recording, letter: str = None):
+    return data_vectorizer.Vectorizer(recording.open_recon(), recording.get_timestamps(letter),
+                                      **recording.get_geometry(), **extraction)
+
+def set_extraction(rotation_step: float = None, interpolation: str = "nearest"):
+    # Mit rotation_step wird jede Augmentierung zu einem Nachschlagen in der
+    # Geometrie-Tabelle, interpolation wählt die Abtastung der Pixel. Gilt für
+    # die geladenen und alle später geladenen Aufnahmen.
+    global extraction
+    extraction = {"rotation_step": rotation_step, "interpolation": interpolation}
+    if vectorizers is not None:
+        for vectorizer in vectorizers:
+            vectorizer.set_extraction(**extraction)
+
+def publish_shared_dataset(descriptor_file: Path = None, workers: int = LOADER_WORKERS):
+    # Legt die Aufnahmen einmal in Shared Memory ab, Trainings-Worker
+    # hängen sich mit use_shared_dataset daran, statt selbst zu lesen
+    global vectorizers, sources, shared
+    published = shared_dataset.publish(__get_vectorizers(workers), sources, descriptor_file)
+    close_vectorizers()
+    shared = published
+    vectorizers = shared.vectorizers
+    sources = shared.sources
+    return shared
+
+def use_shared_dataset(descriptor):
+    global vectorizers, sources, shared
+    close_vectorizers()
+    shared = shared_dataset.attach(descriptor)
+    vectorizers = shared.vectorizers
+    sources = shared.sources
+    return shared
+
+def close_vectorizers():
+    global vectorizers, sources, shared
+    if vectorizers is not None:
+        for vectorizer in vectorizers:
+            if isinstance(vectorizer.frames, data_reader.ReconHandle):
+                vectorizer.frames.close()
+    vectorizers = None
+    sources = None
+    if shared is not None:
+        shared.close()
+        shared = None
+
+def get_randomized_vectors(n_randomizations, seed: int = None, cache: feature_cache.FeatureCache = None,
+                           max_offset = 4, max_rotation = 10, workers: int = 1):
+    if cache is not None and seed is None:
+        raise ValueError("Randomized vectors can only be cached with a seed")
+
+    with instrumentation.stage("load recordings"):
+        vectorizers = __get_vectorizers()
+    # Jede Aufnahme und darin jeder Block von Randomisierungen bekommt einen
+    # eigenen, unabhängigen Zufallsstrom. Das Ergebnis hängt so nicht davon ab,
+    # wie viele Prozesse die Blöcke abarbeiten.
+    recording_seeds = np.random.SeedSequence(seed).spawn(len(vectorizers))
+    chunk_size = RANDOMIZATION_CHUNK_SIZE
+
+    def get_params(idx):
+        return {
+            "seed": seed,
+            "spawn_key": recording_seeds[idx].spawn_key,
+            "n_randomizations": n_randomizations,
+            "chunk_size": chunk_size,
+            "max_offset": max_offset,
+            "max_rotation": max_rotation,
+        }
+
+    def get_tasks(idx):
+        starts = range(0, n_randomizations, chunk_size)
+        chunk_seeds = recording_seeds[idx].spawn(len(starts))
+        return [(chunk_seed, min(chunk_size, n_randomizations - start)) for start, chunk_seed in zip(starts, chunk_seeds)]
+
+    randomize = partial(__randomize_chunk, max_offset=max_offset, max_rotation=max_rotation)
+    return __extract_recordings(randomize, get_params, get_tasks, cache, workers)
+
+def __randomize_chunk(vectorizer: data_vectorizer.Vectorizer, seed_sequence: np.random.SeedSequence,
+                      n_randomizations, max_offset = 4, max_rotation = 10):
+    # Der eigene Strom des Vectorizers bleibt unberührt
+    geometries = vectorizer.get_random_geometries(n_randomizations, max_offset, max_rotation,
+                                                  rng=np.random.default_rng(seed_sequence))
+    return vectorizer.get_planned_vectors(geometries)
+
+def make_augmentation_plan(n_randomizations, seed: int, max_offset = 4, max_rotation = 10):
+    # Zentriert nur, wenn alle Aufnahmen kalibriert sind, wie get_random_geometries
+    vectorizers = __get_vectorizers()
+    centered = len(vectorizers) > 0 and all(vectorizer.calibrated for vectorizer in vectorizers)
+    return augmentation_plan.make_plan(len(vectorizers), n_randomizations, seed, max_offset, max_rotation, centered)
+
+def get_planned_vectors(plan: augmentation_plan.AugmentationPlan, indices = None,
+                        cache: feature_cache.FeatureCache = None, workers: int = 1):
+    # Wie get_randomized_vectors, die Geometrien kommen aber aus dem Plan.
+    # indices wählt Randomisierungen aus, z.B. den noch fehlenden Teil eines
+    # abgebrochenen Laufs, ohne dass sich die übrigen Vektoren ändern.
     vectorizers = __get_vectorizers()
+    if plan.n_recordings != len(vectorizers):
+        raise ValueError(f"Plan has {plan.n_recordings} recordings, {len(vectorizers)} are loaded")
+    if indices is None:
+        indices = np.arange(plan.n_randomizations)
+    indices = np.asarray(indices)
+    chunk_size = RANDOMIZATION_CHUNK_SIZE
+
+    def get_params(idx):
+        return {**plan.get_params(), "recording": idx, "indices": indices.tolist()}
+
+    def get_tasks(idx):
+        return [(plan.get_geometries(idx, indices[start:start + chunk_size]),)
+                for start in range(0, len(indices), chunk_size)]
+
+    return __extract_recordings(__extract_planned_chunk, get_params, get_tasks, cache, workers)
+
+def __extract_planned_chunk(vectorizer: data_vectorizer.Vectorizer, geometries: np.ndarray):
+    return vectorizer.get_planned_vectors(geometries)
+
+def __extract_recordings(extract_chunk, get_params, get_tasks, cache: feature_cache.FeatureCache = None,
+                         workers: int = 1):
+    # Gemeinsamer Ablauf von get_randomized_vectors und get_planned_vectors:
+    # fertige Aufnahmen kommen aus dem Cache, die übrigen werden mit get_tasks
+    # in Blöcke zerlegt, die extract_chunk(vectorizer, *task) abarbeitet, ab
+    # zwei Prozessen parallel. Das Ergebnis bleibt nach Aufnahme und Block sortiert.
+    vectorizers = __get_vectorizers()
+    results = [None] * len(vectorizers)
+    keys = [None] * len(vectorizers)
+    tasks = list()
+    for idx, vectorizer in enumerate(vectorizers):
+        if cache is not None:
+            params = vectorizer.get_params()
+            params.update(get_params(idx))
+            key = cache.get_key(sources[idx], params)
+            results[idx] = cache.load(key)
+            if results[idx] is not None:
+                continue
+            keys[idx] = key
+
+        results[idx] = (list(), list())
+        tasks.extend((idx, task) for task in get_tasks(idx))
+
+    task_vectorizers = [vectorizers[idx] for idx, _ in tasks]
+    task_arguments = list(zip(*(task for _, task in tasks)))
+    with instrumentation.stage("randomize", tasks=len(tasks), workers=workers):
+        if workers > 1 and len(tasks) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                chunks = list(executor.map(extract_chunk, task_vectorizers, *task_arguments))
+        else:
+            chunks = list(map(extract_chunk, task_vectorizers, *task_arguments))
+
+    for (idx, _), (sub_vectors, sub_letters) in zip(tasks, chunks):
+        results[idx][0].extend(sub_vectors)
+        results[idx][1].extend(sub_letters)
+
     vectors = list()
     letters = list()
-    for vectorizer in vectorizers:
-        # print(vectorizer.timestamps)
-        for _ in range(n_randomizations):
-            sub_vectors, sub_letters = vectorizer.get_randomized_vectors()
-            vectors.extend(sub_vectors)
-            letters.extend(sub_letters)
+    for key, (sub_vectors, sub_letters) in zip(keys, results):
+        # Nur neu berechnete Aufnahmen werden in den Cache geschrieben
+        if key is not None:
+            cache.store(key, sub_vectors, sub_letters)
+        vectors.extend(sub_vectors)
+        letters.extend(sub_letters)
     return vectors, letters
 
+def iter_randomized_vectors(n_randomizations, chunk_size: int = RANDOMIZATION_CHUNK_SIZE, seed: int = None,
+                            plan: augmentation_plan.AugmentationPlan = None, max_offset = 4, max_rotation = 10):
+    # Wie get_randomized_vectors, hält aber höchstens chunk_size
+    # Randomisierungen einer Aufnahme gleichzeitig im Speicher. Die Aufnahmen
+    # wechseln sich blockweise ab, damit aufeinanderfolgende Samples nicht
+    # alle aus derselben Aufnahme stammen.
+    # Die Geometrien kommen aus dem Plan oder wie in get_randomized_vectors
+    # aus einem Strom pro Aufnahme und Block, mit gleichem Seed und
+    # chunk_size sind es also dieselben Vektoren.
+    vectorizers = __get_vectorizers()
+    starts = range(0, n_randomizations, chunk_size)
+    if plan is not None:
+        if plan.n_recordings != len(vectorizers):
+            raise ValueError(f"Plan has {plan.n_recordings} recordings, {len(vectorizers)} are loaded")
+        if n_randomizations > plan.n_randomizations:
+            raise ValueError(f"Plan has {plan.n_randomizations} randomizations, {n_randomizations} requested")
+    else:
+        recording_seeds = np.random.SeedSequence(seed).spawn(len(vectorizers))
+        chunk_seeds = [recording_seed.spawn(len(starts)) for recording_seed in recording_seeds]
+
+    for chunk, start in enumerate(starts):
+        count = min(chunk_size, n_randomizations - start)
+        for idx, vectorizer in enumerate(vectorizers):
+            if plan is not None:
+                geometries = plan.get_geometries(idx, slice(start, start + count))
+            else:
+                geometries = vectorizer.get_random_geometries(count, max_offset, max_rotation,
+                                                              rng=np.random.default_rng(chunk_seeds[idx][chunk]))
+            sub_vectors, sub_letters = vectorizer.get_planned_vectors(geometries)
+            yield from zip(sub_vectors, sub_letters)
+
 def get_default_vectors():
     vectorizers = __get_vectorizers()
     vectors = list()
@@ -49,6 +281,15 @@ def get_max_frames():
         length = max(length, vectorizer.get_max_frames())
     return length
 
+def get_segment_lengths():
+    # Frames pro Segment direkt aus den Zeitstempeln, ohne Vektoren zu extrahieren
+    vectorizers = __get_vectorizers()
+    lengths = [
+        (vectorizer.timestamps["last_frame"] - vectorizer.timestamps["first_frame"]).to_numpy(dtype=np.int64)
+        for vectorizer in vectorizers
+    ]
+    return np.concatenate(lengths) if lengths else np.zeros(0, dtype=np.int64)
+
 def get_all_letters():
     vectorizers = __get_vectorizers()
     letters = set()
@@ -56,21 +297,167 @@ def get_all_letters():
         letters.update(vectorizer.get_letters())
     return letters
 
-def make_numpy(vectors, length: int):
-    shape = (len(vectors), 7, 20, length)
-    new_vectors = np.zeros(shape)
-    for idx, vector in enumerate(vectors):
-        new_vectors[idx, :, :, :vector.shape[-1]] = vector.copy()
-        
+def get_letter_indices():
+    return {
+        letter: idx
+        for idx, letter in enumerate(sorted(get_all_letters()))
+    }
+
+def make_dataset(n_randomizations, length: int = None, batch_size: int = 32,
+                 cnn: bool = False, prefetch: int = 2, dtype=np.float32,
+                 shuffle_buffer: int = SHUFFLE_BUFFER, seed: int = None,
+                 plan: augmentation_plan.AugmentationPlan = None):
+    # seed bestimmt die Augmentierung und das Mischen, ein Plan ersetzt
+    # die gezogenen Geometrien
+    if length is None:
+        length = get_max_frames()
+    letter_indices = get_letter_indices()
+    vector_count = data_vectorizer.Vectorizer.VECTOR_COUNT
+    vector_length = data_vectorizer.Vectorizer.VECTOR_LENGTH
+
+    def generator():
+        for vector, letter in iter_randomized_vectors(n_randomizations, seed=seed, plan=plan):
+            yield vector.astype(dtype), letter_indices[letter]
+
+    dataset = tensorflow.data.Dataset.from_generator(
+        generator,
+        output_signature=(
+            tensorflow.TensorSpec((vector_count, vector_length, None), dtype),
+            tensorflow.TensorSpec((), tensorflow.int32),
+        ))
+    # Gemischt wird vor dem Auffüllen, im Puffer liegen also nur die
+    # ungepolsterten Segmente. 0 schaltet das Mischen ab.
+    if shuffle_buffer:
+        dataset = dataset.shuffle(shuffle_buffer, seed=seed)
+    # Aufgefüllt wird wie in make_numpy hinten mit Nullen
+    dataset = dataset.padded_batch(
+        batch_size,
+        padded_shapes=((vector_count, vector_length, length), ()))
+
+    def to_model_input(vectors, letters):
+        if not cnn:
+            vectors = tensorflow.reshape(vectors, (-1, vector_count, vector_length*length))
+        return vectors, tensorflow.one_hot(letters, len(letter_indices))
+
+    dataset = dataset.map(to_model_input)
+    return dataset.prefetch(prefetch)
+
+def make_numpy(vectors, length: int, dtype=np.float64):
+    new_vectors = make_numpy_cnn(vectors, length, dtype)
     return np.reshape(new_vectors, (len(vectors), 7, 20*length))
-    #return new_vectors
 
-def make_numpy_cnn(vectors, length: int):
+def make_numpy_cnn(vectors, length: int, dtype=np.float64):
     shape = (len(vectors), 7, 20, length)
-    new_vectors = np.zeros(shape)
-    for idx, vector in enumerate(vectors):
-        new_vectors[idx, :, :, :vector.shape[-1]] = vector.copy()
-        
-    #return np.reshape(new_vectors, (len(vectors), 7, 20*length))
+    with instrumentation.stage("padding", samples=len(vectors)):
+        new_vectors = np.zeros(shape, dtype=dtype)
+        for idx, vector in enumerate(vectors):
+            new_vectors[idx, :, :, :vector.shape[-1]] = vector
+
     return new_vectors
 
+class RaggedVectors:
+    # Alle Vektoren hintereinander entlang der Frame-Achse, ohne Auffüllen.
+    # Segment i liegt in values[..., offsets[i]:offsets[i+1]].
+
+    values: np.ndarray
+    offsets: np.ndarray
+
+    def __init__(self, values: np.ndarray, offsets: np.ndarray) -> None:
+        self.values = values
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx: int):
+        return self.values[..., self.offsets[idx]:self.offsets[idx + 1]]
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + self.offsets.nbytes
+
+    def pad(self, indices, length: int = None, bucket_size: int = 1):
+        # Füllt nur die ausgewählten Segmente auf, auf das längste davon
+        # (aufgerundet auf ein Vielfaches von bucket_size) oder auf length
+        indices = np.asarray(indices)
+        lengths = self.lengths[indices]
+        if length is None:
+            longest = int(lengths.max()) if len(indices) else 0
+            length = -(-longest // bucket_size) * bucket_size
+
+        with instrumentation.stage("padding", samples=len(indices)):
+            batch = np.zeros((len(indices), *self.values.shape[:-1], length), dtype=self.values.dtype)
+            for row, idx in zip(batch, indices):
+                segment = self[idx]
+                row[..., :segment.shape[-1]] = segment
+        return batch
+
+def make_buckets(lengths, batch_size: int = 32, shuffle: bool = True, seed: int = None):
+    # Sortiert die Segmente nach Länge und schneidet daraus Batches, damit in
+    # einem Batch nur ähnlich lange Segmente liegen. Gemischt werden die
+    # Segmente gleicher Länge und die Reihenfolge der Batches.
+    lengths = np.asarray(lengths)
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(lengths)) if shuffle else np.arange(len(lengths))
+    order = order[np.argsort(lengths[order], kind="stable")]
+    batches = [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
+    if shuffle:
+        batches = [batches[idx] for idx in rng.permutation(len(batches))]
+    return batches
+
+def get_padding_ratio(lengths, batches = None, length: int = None, bucket_size: int = 1):
+    # Anteil der aufgefüllten Nullen an allen Frames. Ohne batches wird wie in
+    # make_numpy alles auf length bzw. das längste Segment aufgefüllt.
+    lengths = np.asarray(lengths)
+    if batches is None:
+        width = length if length is not None else int(lengths.max(initial=0))
+        padded = width * len(lengths)
+    else:
+        padded = 0
+        for batch in batches:
+            longest = int(lengths[batch].max(initial=0))
+            padded += -(-longest // bucket_size) * bucket_size * len(batch)
+    if padded == 0:
+        return 0.0
+    return float(1 - lengths.sum() / padded)
+
+def get_padding_report(lengths, batch_size: int = 32, bucket_size: int = 1, length: int = None, seed: int = None):
+    batches = make_buckets(lengths, batch_size, seed=seed)
+    return {
+        "segments": len(lengths),
+        "batches": len(batches),
+        "padding_fixed": get_padding_ratio(lengths, length=length),
+        "padding_bucketed": get_padding_ratio(lengths, batches, bucket_size=bucket_size),
+    }
+
+def iter_bucketed_batches(vectors, letters, batch_size: int = 32, bucket_size: int = 1, cnn: bool = False,
+                          shuffle: bool = True, seed: int = None):
+    # Jeder Batch wird nur auf sein eigenes längstes Segment aufgefüllt, die
+    # Frame-Achse ändert sich also von Batch zu Batch. Ohne cnn liegen die
+    # Frames als Zeitachse vorne, (Batch, Frames, 7*20), damit ein LSTM mit
+    # variabler Länge sie lesen kann. Für Modelle mit fester Eingabelänge
+    # muss weiter make_numpy verwendet werden.
+    if not isinstance(vectors, RaggedVectors):
+        vectors = make_ragged(vectors)
+    letter_indices = get_letter_indices()
+    labels = np.array([letter_indices[letter] for letter in letters], dtype=np.int32)
+    one_hot = np.eye(len(letter_indices), dtype=np.float32)
+    for batch in make_buckets(vectors.lengths, batch_size, shuffle, seed):
+        padded = vectors.pad(batch, bucket_size=bucket_size)
+        if not cnn:
+            padded = np.ascontiguousarray(padded.transpose(0, 3, 1, 2)).reshape((len(batch), padded.shape[-1], -1))
+        yield padded, one_hot[labels[batch]]
+
+def make_ragged(vectors, dtype=np.float32):
+    lengths = [vector.shape[-1] for vector in vectors]
+    offsets = np.zeros(len(vectors) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    if vectors:
+        values = np.concatenate(vectors, axis=-1, dtype=dtype)
+    else:
+        values = np.zeros((7, 20, 0), dtype=dtype)
+    return RaggedVectors(values, offsets)
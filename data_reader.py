@@ -3,11 +3,15 @@ import h5py
 from pathlib import Path
 import numpy as np
 
+import instrumentation
+
 BASE_FOLDER = Path("data", "sub001")
 
 FRAME_RATE = 83.28
 FRAME_DURATION = 1/FRAME_RATE
 
+SEGMENT_TABLE_SUFFIX = ".segments.npz"
+
 
 def get_mapper(mapper_file: Path = None) -> pd.DataFrame:
     if mapper_file is None:
@@ -17,11 +21,90 @@ def get_mapper(mapper_file: Path = None) -> pd.DataFrame:
     return mapper
 
 
+def get_timestamps_path(filename: Path):
+    return BASE_FOLDER / "timestamps" / filename
+
+
 def get_timestamps(filename: Path):
-    filepath = BASE_FOLDER / "timestamps" / filename
+    return read_timestamps(get_timestamps_path(filename))
+
+
+def read_timestamps(filepath: Path):
+    filepath = Path(filepath)
+    table_path = get_segment_table_path(filepath)
+    # Die Tabelle wird nur verwendet, solange die Quelldatei nicht neuer ist
+    if table_path.exists() and table_path.stat().st_mtime_ns >= filepath.stat().st_mtime_ns:
+        with instrumentation.stage("segment table read"):
+            return __read_segment_table(table_path)
+
+    with instrumentation.stage("timestamp parsing", file=filepath.name):
+        df = __read_timestamps(filepath)
+        df = __clean_timestamps(df)
+    try:
+        __write_segment_table(df, table_path)
+    except OSError:
+        pass
+    return df
+
+
+def get_segment_table_path(filepath: Path):
+    return filepath.with_name(filepath.name + SEGMENT_TABLE_SUFFIX)
+
+
+def convert_timestamps(filepath: Path):
+    filepath = Path(filepath)
     df = __read_timestamps(filepath)
     df = __clean_timestamps(df)
-    return df
+    table_path = get_segment_table_path(filepath)
+    __write_segment_table(df, table_path)
+    return table_path
+
+
+def convert_all_timestamps(root: Path = Path("data")):
+    return [
+        convert_timestamps(filepath)
+        for filepath in sorted(Path(root).glob("sub*/timestamps/*"))
+        if filepath.suffix in (".csv", ".xlsx") and filepath.name != "mapper.csv"
+    ]
+
+
+def get_segment_arrays(df: pd.DataFrame):
+    # Segment-Tabelle als Arrays mit ganzen Millisekunden und Frames, z.B. für
+    # die .npz-Tabelle, das Manifest oder Shared Memory. make_timestamps macht
+    # daraus wieder dieselbe Tabelle. Die Spalte mit der Buchstabennummer heißt
+    # je nach Quelle unterschiedlich, ihr Name wird mitgegeben.
+    number_column = df.columns[1]
+    return {
+        "letters": df["Buchstabe"].to_numpy(dtype=str),
+        "numbers": df[number_column].to_numpy(dtype=np.int64),
+        "number_column": np.array(number_column),
+        "start_ms": (df["Timestamp start"].dt.total_seconds() * 1000).round().to_numpy(dtype=np.int64),
+        "end_ms": (df["Timestamp ende"].dt.total_seconds() * 1000).round().to_numpy(dtype=np.int64),
+        "first_frame": df["first_frame"].to_numpy(dtype=np.int64),
+        "last_frame": df["last_frame"].to_numpy(dtype=np.int64),
+    }
+
+
+def make_timestamps(arrays):
+    # Umkehrung von get_segment_arrays, arrays kann auch eine geöffnete .npz-Datei sein
+    return pd.DataFrame({
+        "Buchstabe": np.asarray(arrays["letters"], dtype=str),
+        str(arrays["number_column"]): np.asarray(arrays["numbers"]),
+        "Timestamp start": np.asarray(arrays["start_ms"]).astype("timedelta64[ms]").astype("timedelta64[ns]"),
+        "Timestamp ende": np.asarray(arrays["end_ms"]).astype("timedelta64[ms]").astype("timedelta64[ns]"),
+        "first_frame": np.asarray(arrays["first_frame"]).astype(float),
+        "last_frame": np.asarray(arrays["last_frame"]).astype(float),
+    })
+
+
+def __write_segment_table(df: pd.DataFrame, table_path: Path):
+    with open(table_path, "wb") as file:
+        np.savez(file, **get_segment_arrays(df))
+
+
+def __read_segment_table(table_path: Path):
+    with np.load(table_path) as table:
+        return make_timestamps(table)
 
 
 def __read_timestamps(filepath: Path):
@@ -72,9 +155,117 @@ def __clean_timestamps(df: pd.DataFrame):
     return df
 
 
+def get_recon_path(filename: Path):
+    return BASE_FOLDER / "2drt" / "recon" / filename
+
+
 def get_recon(filename: Path):
-    filepath = BASE_FOLDER / "2drt" / "recon" / filename
-    recon = h5py.File(filepath)["recon"][:]
-    recon = np.rot90(recon, k=3, axes=(1,2))
-    recon = np.flip(recon, axis=2)
-    return recon
\ No newline at end of file
+    filepath = get_recon_path(filename)
+    with instrumentation.stage("h5 read", file=filepath.name):
+        with h5py.File(filepath, "r") as file:
+            recon = file["recon"][:]
+    instrumentation.count("h5 bytes read", recon.nbytes)
+    with instrumentation.stage("rotate/flip"):
+        recon = np.rot90(recon, k=3, axes=(1,2))
+        recon = np.flip(recon, axis=2)
+        # Zusammenhängend ablegen, damit Frames ohne Kopie als flache Ebenen gelesen werden können
+        return np.ascontiguousarray(recon)
+
+def open_recon(filename: Path):
+    return ReconHandle(get_recon_path(filename))
+
+
+class ReconHandle:
+    # Liest die Frames einer Aufnahme erst bei Bedarf aus der H5-Datei.
+    # rot90 und flip aus get_recon ergeben zusammen nur eine Vertauschung
+    # der beiden Bildachsen, die als View ohne Kopie zurückgegeben wird.
+
+    filepath: Path
+    shape: tuple
+    dtype: np.dtype
+
+    def __init__(self, filepath: Path) -> None:
+        self.filepath = Path(filepath)
+        self.__file = None
+        self.__data = None
+
+        with h5py.File(self.filepath, "r") as file:
+            dataset = file["recon"]
+            frame_count, height, width = dataset.shape
+            self.shape = (frame_count, width, height)
+            self.dtype = dataset.dtype
+
+
+    @property
+    def plane_strides(self):
+        # Schrittweiten von (x, y) in einem flachen, nicht vertauschten Frame
+        return 1, self.shape[1]
+
+
+    def __len__(self):
+        return self.shape[0]
+
+
+    def __getitem__(self, key: slice):
+        if not isinstance(key, slice):
+            raise TypeError(f"Only slices of frames are supported, got {type(key).__name__}")
+        return self.read(key).transpose(0, 2, 1)
+
+
+    def read(self, key: slice = slice(None)):
+        if self.__data is None:
+            self.__open()
+        with instrumentation.stage("h5 read"):
+            frames = self.__data[key]
+        instrumentation.count("h5 bytes read", frames.nbytes)
+        return frames
+
+
+    def read_planes(self, first_frame: int, last_frame: int):
+        frames = self.read(slice(first_frame, last_frame))
+        return np.ascontiguousarray(frames).reshape(len(frames), frames.shape[1] * frames.shape[2])
+
+
+    def __open(self):
+        file = h5py.File(self.filepath, "r")
+        dataset = file["recon"]
+
+        # Zusammenhängende, unkomprimierte Datasets können direkt gemappt werden
+        offset = dataset.id.get_offset()
+        if dataset.chunks is None and dataset.compression is None and offset is not None:
+            self.__data = np.memmap(self.filepath, mode="r", dtype=dataset.dtype,
+                                    offset=offset, shape=dataset.shape)
+            file.close()
+        else:
+            self.__file = file
+            self.__data = dataset
+
+
+    def close(self):
+        # Eine memmap hält keinen Dateideskriptor offen, das Mapping
+        # verschwindet mit der letzten Referenz darauf
+        if self.__file is not None:
+            self.__file.close()
+        self.__file = None
+        self.__data = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def __getstate__(self):
+        # Offene Dateien werden nicht mitgegeben, der Empfänger öffnet neu
+        return {"filepath": self.filepath, "shape": self.shape, "dtype": self.dtype}
+
+
+    def __setstate__(self, state):
+        self.filepath = state["filepath"]
+        self.shape = state["shape"]
+        self.dtype = state["dtype"]
+        self.__file = None
+        self.__data = None
@@ -5,6 +5,33 @@ import math
 import pandas as pd
 import torch
 
+import instrumentation
+from collections import OrderedDict
+
+
+# LRU-Cache für die flachen Pixel-Indizes einer Vektor-Geometrie
+class GeometryCache:
+
+    def __init__(self, maxsize: int = 4096) -> None:
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        indices = self.entries.get(key)
+        if indices is not None:
+            self.entries.move_to_end(key)
+        return indices
+
+    def put(self, key, indices: np.ndarray):
+        self.entries[key] = indices
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+
 class Vectorizer:
     VECTOR_LENGTH = 20
     VECTOR_COUNT = 7
@@ -20,51 +47,298 @@ class Vectorizer:
     frames: np.array
     timestamps: pd.DataFrame
     rng: np.random.Generator
+    seed: int
+    rotation_step: float
+    geometry_cache: GeometryCache
+    interpolation: str
 
+    INTERPOLATIONS = ("nearest", "bilinear")
 
-    def __init__(self, frames: np.array, timestamps: pd.DataFrame) -> None:
+
+    def __init__(self, frames: np.array, timestamps: pd.DataFrame,
+                 rotation_step: float = None, geometry_cache_size: int = 4096,
+                 seed = None, interpolation: str = "nearest", x_offset: int = None,
+                 y_offset: int = None, rotation_offset: float = None) -> None:
         self.frames = frames
         self.timestamps = timestamps
 
-        self.rng = np.random.default_rng()
+        # Kalibrierte Geometrie einer Aufnahme ersetzt die Standardwerte der Klasse
+        self.calibrated = x_offset is not None or y_offset is not None or rotation_offset is not None
+        if x_offset is not None:
+            self.X_OFFSET = x_offset
+        if y_offset is not None:
+            self.Y_OFFSET = y_offset
+        if rotation_offset is not None:
+            self.ROTATION_OFFSET_DEGREES = rotation_offset
+
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+
+        self.geometry_cache = GeometryCache(geometry_cache_size)
+        self.rotation_step = None
+        self.set_extraction(rotation_step, interpolation)
+
+
+    def set_extraction(self, rotation_step: float = None, interpolation: str = "nearest"):
+        # Mit rotation_step wird die Rotation auf Vielfache davon gerundet und
+        # die Pixel-Indizes jeder Geometrie werden nur einmal berechnet.
+        # "bilinear" tastet zwischen den Pixeln ab, statt auf das nächste zu runden.
+        if interpolation not in self.INTERPOLATIONS:
+            raise ValueError(f"Unknown interpolation: {interpolation}")
+        if interpolation != "nearest" and rotation_step is not None:
+            raise ValueError("The geometry lookup table only supports nearest interpolation")
+        if rotation_step != self.rotation_step:
+            # Die Schlüssel der Tabelle hängen von der Schrittweite ab
+            self.geometry_cache = GeometryCache(self.geometry_cache.maxsize)
+        self.rotation_step = rotation_step
+        self.interpolation = interpolation
     
 
     def get_randomized_vectors(self, max_offset = 4, max_rotation = 10):
-        relative = self.get_vectors_relative_position(max_rotation)
-        absolute = self.get_vectors_absolute_position(relative, max_offset)
+        # Eine Randomisierung, gleiche Zufallszahlen und Werte wie früher die
+        # Einzelberechnung, aber mit Geometrie-Tabelle und Interpolation
+        return self.get_randomized_vectors_batch(1, max_offset, max_rotation)
+
+
+    def get_randomized_vectors_batch(self, n_randomizations: int, max_offset = 4, max_rotation = 10):
+        return self.get_planned_vectors(self.get_random_geometries(n_randomizations, max_offset, max_rotation))
+
+
+    def get_planned_vectors(self, geometries: np.ndarray):
+        # geometries sind Zeilen (Rotation, dx, dy) relativ zur Standard-Geometrie,
+        # z.B. aus get_random_geometries oder einem augmentation_plan.AugmentationPlan
+        return self.get_vectors_for_geometries(*self.get_absolute_geometries(geometries))
+
+
+    def get_absolute_geometries(self, geometries: np.ndarray):
+        geometries = np.asarray(geometries).reshape(-1, 3)
+        rotations = self.ROTATION_OFFSET_DEGREES + geometries[:, 0]
+        x_offsets = self.X_OFFSET + geometries[:, 1].astype(np.intp)
+        y_offsets = self.Y_OFFSET + geometries[:, 2].astype(np.intp)
+        return rotations, x_offsets, y_offsets
+
 
-        vectors = list()
-        letters = list()
+    def get_vectors_for_geometries(self, rotations: np.ndarray, x_offsets: np.ndarray, y_offsets: np.ndarray):
+        n_randomizations = len(rotations)
+        if self.interpolation == "bilinear":
+            positions = self.get_vectors_coordinates(rotations, x_offsets, y_offsets)
+            get_pixel_data = self.get_pixel_data_bilinear
+        elif self.rotation_step is None:
+            positions = self.get_vectors_positions(rotations, x_offsets, y_offsets)
+            get_pixel_data = self.get_pixel_data_batch
+        else:
+            positions = self.get_flat_indices(rotations, x_offsets, y_offsets)
+            get_pixel_data = self.get_pixel_data_flat
+
+        segments = list()
         for idx, row in self.timestamps.iterrows():
-            vectors.append(
-                self.get_pixel_data(
-                    absolute,
+            segments.append(
+                get_pixel_data(
+                    positions,
                     int(row["first_frame"]),
                     int(row["last_frame"])
                 ))
-            letters.append(row["Buchstabe"])
+        letters = list(self.timestamps["Buchstabe"])
 
-        return vectors, letters
+        # Gleiche Reihenfolge wie n_randomizations Aufrufe von get_randomized_vectors
+        vectors = [segment[n] for n in range(n_randomizations) for segment in segments]
+        return vectors, letters * n_randomizations
 
 
     def get_pixel_data(self, vector_positions: np.array, first_frame: int, last_frame: int):
+        # Ganzzahlige Positionen, bilinear ergäbe dort dieselben Werte. Mit
+        # Interpolation muss über get_vectors_for_geometries gegangen werden.
+        return self.get_pixel_data_batch(vector_positions[np.newaxis], first_frame, last_frame)[0]
+
+
+    def get_pixel_data_batch(self, vector_positions: np.array, first_frame: int, last_frame: int):
         total_frames = last_frame - first_frame
         frames = self.frames[first_frame:last_frame]
 
+        geometry_count = len(vector_positions)
         vector_count = self.VECTOR_COUNT
         vector_length = self.VECTOR_LENGTH
 
-        vectors = np.ones((vector_count, total_frames, vector_length))
-        for vector_coords, image in zip(vector_positions, vectors):
-            for col, frame in zip(image, frames):
-                xs = [coords[0] for coords in vector_coords]
-                ys = [coords[1] for coords in vector_coords]
-                col[:] = frame[xs, ys]
+        # Die Pixel werden rückwärts gelesen, damit das Ergebnis direkt in der
+        # Reihenfolge (Geometrie, Vektor, Pixel, Frame) vorliegt und kein rot90 nötig ist
+        xs = vector_positions[:, :, ::-1, 0, np.newaxis]
+        ys = vector_positions[:, :, ::-1, 1, np.newaxis]
+        frame_idx = np.arange(len(frames))
 
-        vectors = np.rot90(vectors, axes=(1, 2))
+        with instrumentation.stage("pixel gather"):
+            vectors = np.empty((geometry_count, vector_count, vector_length, total_frames))
+            # Die Zwischenkopie ist gewollt: np.take(planes.T, ..., out=...) kopiert
+            # vorher die transponierten Ebenen des ganzen Segments zusammenhängend
+            # (bei einer Geometrie 3-7x langsamer) und kann float32-Recons nicht in
+            # das float64-Ergebnis umwandeln. Die Kopie ist so groß wie das Ergebnis.
+            vectors[..., :len(frames)] = frames[frame_idx, xs, ys]
+            # Frames hinter dem Ende der Aufnahme bleiben wie bisher auf 1
+            vectors[..., len(frames):] = 1
         return vectors
 
 
+    def get_pixel_data_bilinear(self, vector_coordinates: np.ndarray, first_frame: int, last_frame: int):
+        total_frames = last_frame - first_frame
+        planes = self.get_frame_planes(first_frame, last_frame)
+        height, width = self.frames.shape[1:]
+        x_stride, y_stride = self.get_plane_strides()
+
+        geometry_count = len(vector_coordinates)
+        vector_count = self.VECTOR_COUNT
+        vector_length = self.VECTOR_LENGTH
+
+        # Pixel rückwärts wie in get_pixel_data_batch
+        xs = vector_coordinates[:, :, ::-1, 0]
+        ys = vector_coordinates[:, :, ::-1, 1]
+        x0 = np.floor(xs)
+        y0 = np.floor(ys)
+        fx = xs - x0
+        fy = ys - y0
+        x0 = x0.astype(np.intp)
+        y0 = y0.astype(np.intp)
+        x1 = np.minimum(x0 + 1, height - 1)
+        y1 = np.minimum(y0 + 1, width - 1)
+
+        # Alle vier Nachbarn in einem Zugriff, Achsen (Nachbar, Geometrie, Vektor, Pixel, Frame)
+        neighbours = np.stack((x0, x1, x0, x1)) * x_stride + np.stack((y0, y0, y1, y1)) * y_stride
+        weights = np.stack(((1 - fx) * (1 - fy), fx * (1 - fy), (1 - fx) * fy, fx * fy))[..., np.newaxis]
+
+        with instrumentation.stage("pixel gather"):
+            vectors = np.empty((geometry_count, vector_count, vector_length, total_frames))
+            samples = np.take(planes.T, neighbours, axis=0)
+            np.einsum("k...,k...->...", weights, samples, out=vectors[..., :len(planes)])
+            vectors[..., len(planes):] = 1
+        return vectors
+
+
+    def get_randomized_vectors_incremental(self, n_randomizations: int, max_offset = 4, max_rotation = 10):
+        # Wie get_randomized_vectors_batch, aber jedes Frame wird pro Geometrie
+        # nur einmal gelesen und die Segmente sind Views in die Feature-Spur.
+        # Die Werte haben den Typ der Recon statt float64, die Spur belegt
+        # Randomisierungen * Frames * 140 Werte, auch wenn die Segmente nur
+        # einen Teil der Aufnahme abdecken.
+        if self.interpolation != "nearest":
+            raise ValueError("Feature tracks only support nearest interpolation")
+        geometries = self.get_random_geometries(n_randomizations, max_offset, max_rotation)
+        rotations, x_offsets, y_offsets = self.get_absolute_geometries(geometries)
+        if self.rotation_step is None:
+            plane_indices = self.get_plane_indices(self.get_vectors_positions(rotations, x_offsets, y_offsets))
+        else:
+            plane_indices = self.get_flat_indices(rotations, x_offsets, y_offsets)
+        tracks = self.get_feature_tracks(plane_indices)
+
+        segments = list()
+        for idx, row in self.timestamps.iterrows():
+            first_frame = int(row["first_frame"])
+            last_frame = int(row["last_frame"])
+            segment = self.get_segment(tracks, first_frame, last_frame)
+            if segment.shape[-1] < last_frame - first_frame:
+                # Frames hinter dem Ende der Aufnahme wie in get_pixel_data_batch
+                # auf 1, dieses Segment ist dann eine Kopie
+                padded = np.ones((*segment.shape[:-1], last_frame - first_frame), dtype=segment.dtype)
+                padded[..., :segment.shape[-1]] = segment
+                segment = padded
+            segments.append(segment)
+        letters = list(self.timestamps["Buchstabe"])
+
+        vectors = [segment[n] for n in range(n_randomizations) for segment in segments]
+        return vectors, letters * n_randomizations
+
+
+    def get_feature_tracks(self, plane_indices: np.ndarray, dtype=None, chunk_size: int = 1024):
+        # Spur der Form (Geometrie, Frame, Vektor, Pixel) über die ganze Aufnahme.
+        # plane_indices sind flache Indizes in die Ebenen aus get_frame_planes,
+        # z.B. aus get_plane_indices oder get_flat_indices. Ohne dtype im Typ der
+        # Recon, 100 Geometrien über 8000 Frames sind bei float32 etwa 450 MB.
+        if dtype is None:
+            dtype = self.frames.dtype
+        geometry_count = len(plane_indices)
+        frame_count = len(self.frames)
+
+        tracks = np.empty((geometry_count, frame_count, self.VECTOR_COUNT, self.VECTOR_LENGTH), dtype=dtype)
+        for first_frame in range(0, frame_count, chunk_size):
+            planes = self.get_frame_planes(first_frame, min(first_frame + chunk_size, frame_count))
+            with instrumentation.stage("pixel gather"):
+                tracks[:, first_frame:first_frame + len(planes)] = np.moveaxis(
+                    np.take(planes, plane_indices, axis=1), 0, 1)
+        return tracks
+
+
+    def get_plane_indices(self, vector_positions: np.ndarray):
+        # Pixel rückwärts, wie in get_pixel_data_batch
+        x_stride, y_stride = self.get_plane_strides()
+        return vector_positions[..., ::-1, 0] * x_stride + vector_positions[..., ::-1, 1] * y_stride
+
+
+    @staticmethod
+    def get_segment(tracks: np.ndarray, first_frame: int, last_frame: int):
+        # View der Form (..., Vektor, Pixel, Frame) ohne Kopie. Anders als
+        # get_pixel_data wird hinter dem Ende der Aufnahme nicht aufgefüllt.
+        return np.moveaxis(tracks[..., first_frame:last_frame, :, :], -3, -1)
+
+
+    @staticmethod
+    def get_windows(tracks: np.ndarray, window: int, hop: int = 1):
+        # Alle gleitenden Fenster als View der Form (..., Fenster, Vektor, Pixel, Frame)
+        windows = np.lib.stride_tricks.sliding_window_view(tracks, window, axis=-3)
+        return windows[..., ::hop, :, :, :]
+
+
+    def get_frame_column(self, frame: np.ndarray, vector_positions: np.array):
+        # Die Werte eines einzelnen Frames, also eine Spalte von get_pixel_data
+        xs = vector_positions[:, ::-1, 0]
+        ys = vector_positions[:, ::-1, 1]
+        return frame[xs, ys]
+
+
+    def get_pixel_data_flat(self, flat_indices: np.ndarray, first_frame: int, last_frame: int):
+        total_frames = last_frame - first_frame
+        planes = self.get_frame_planes(first_frame, last_frame)
+
+        geometry_count = len(flat_indices)
+        vector_count = self.VECTOR_COUNT
+        vector_length = self.VECTOR_LENGTH
+
+        with instrumentation.stage("pixel gather"):
+            vectors = np.empty((geometry_count, vector_count, vector_length, total_frames))
+            vectors[..., :len(planes)] = np.take(planes.T, flat_indices, axis=0)
+            vectors[..., len(planes):] = 1
+        return vectors
+
+
+    def get_frame_planes(self, first_frame: int, last_frame: int):
+        if isinstance(self.frames, np.ndarray):
+            frames = self.frames[first_frame:last_frame]
+            # Für die zusammenhängenden Arrays aus data_reader.get_recon ist das eine View
+            return np.ascontiguousarray(frames).reshape(len(frames), frames.shape[1] * frames.shape[2])
+        return self.frames.read_planes(first_frame, last_frame)
+
+
+    def get_plane_strides(self):
+        if isinstance(self.frames, np.ndarray):
+            return self.frames.shape[-1], 1
+        return self.frames.plane_strides
+
+
+    def get_flat_indices(self, rotations: np.ndarray, x_offsets: np.ndarray, y_offsets: np.ndarray):
+        with instrumentation.stage("geometry lookup"):
+            rotation_step = self.rotation_step
+
+            steps = np.round(np.asarray(rotations) / rotation_step).astype(np.intp)
+            flat_indices = np.empty((len(steps), self.VECTOR_COUNT, self.VECTOR_LENGTH), dtype=np.intp)
+            keys = zip(steps.tolist(), np.asarray(x_offsets).tolist(), np.asarray(y_offsets).tolist())
+            for idx, key in enumerate(keys):
+                indices = self.geometry_cache.get(key)
+                if indices is None:
+                    instrumentation.count("geometry cache misses")
+                    step, x_offset, y_offset = key
+                    positions = self.get_vectors_positions([step * rotation_step], [x_offset], [y_offset])[0]
+                    indices = self.get_plane_indices(positions)
+                    self.geometry_cache.put(key, indices)
+                flat_indices[idx] = indices
+            return flat_indices
+
+
     def get_mask(self, vectors_absolute_position):
         vector_mask = np.ones((self.IMAGE_SIZE, self.IMAGE_SIZE))
         for vector in vectors_absolute_position:
@@ -104,6 +378,66 @@ class Vectorizer:
         return vectors
     
 
+    def get_random_geometries(self, n_randomizations: int, max_offset = 4, max_rotation = 10,
+                              rng: np.random.Generator = None, centered: bool = None):
+        # Zeilen (Rotation, dx, dy) relativ zur Standard-Geometrie. Die Zufallszahlen
+        # werden in derselben Reihenfolge wie in get_vectors_relative_position und
+        # get_vectors_absolute_position gezogen, abgerundet wird wie dort int() auf
+        # den positiven absoluten Offsets.
+        # Die alte Formel verschiebt nur in {-2*max_offset, ..., -max_offset - 1}, was
+        # zu den fest eingestellten Offsets der Klasse passt. Um eine kalibrierte Mitte
+        # wird stattdessen gleichverteilt in {-max_offset, ..., max_offset} verschoben.
+        if rng is None:
+            rng = self.rng
+        if centered is None:
+            centered = self.calibrated
+        instrumentation.count("geometries drawn", n_randomizations)
+        draws = rng.random((n_randomizations, 3))
+        geometries = np.empty((n_randomizations, 3))
+        geometries[:, 0] = draws[:, 0] * 2*max_rotation - max_rotation
+        if centered:
+            geometries[:, 1:] = np.floor(draws[:, 1:] * (2*max_offset + 1)) - max_offset
+        else:
+            geometries[:, 1:] = np.floor(-draws[:, 1:] * 2*max_offset - max_offset)
+        return geometries
+
+
+    def get_vectors_positions(self, rotations: np.ndarray, x_offsets: np.ndarray, y_offsets: np.ndarray):
+        with instrumentation.stage("geometry"):
+            vector_count = self.VECTOR_COUNT
+            vector_length = self.VECTOR_LENGTH
+            vector_span_degrees = self.VECTOR_SPAN_DEGREES
+
+            vector_spacing_degrees = vector_span_degrees / (vector_count - 1)
+            angles = vector_spacing_degrees*np.arange(vector_count) + np.asarray(rotations)[:, np.newaxis]
+            rad = np.radians(angles)[..., np.newaxis]
+            distances = np.arange(vector_length)
+
+            vectors = np.empty((len(angles), vector_count, vector_length, 2), dtype=np.intp)
+            vectors[..., 0] = np.round(np.sin(rad) * distances)
+            vectors[..., 1] = np.round(np.cos(rad) * distances)
+            vectors[..., 0] += np.asarray(y_offsets)[:, np.newaxis, np.newaxis]
+            vectors[..., 1] += np.asarray(x_offsets)[:, np.newaxis, np.newaxis]
+            return vectors
+
+
+    def get_vectors_coordinates(self, rotations: np.ndarray, x_offsets: np.ndarray, y_offsets: np.ndarray):
+        # Wie get_vectors_positions, aber ohne auf ganze Pixel zu runden
+        with instrumentation.stage("geometry"):
+            vector_count = self.VECTOR_COUNT
+            vector_length = self.VECTOR_LENGTH
+
+            vector_spacing_degrees = self.VECTOR_SPAN_DEGREES / (vector_count - 1)
+            angles = vector_spacing_degrees*np.arange(vector_count) + np.asarray(rotations)[:, np.newaxis]
+            rad = np.radians(angles)[..., np.newaxis]
+            distances = np.arange(vector_length)
+
+            vectors = np.empty((len(angles), vector_count, vector_length, 2))
+            vectors[..., 0] = np.sin(rad) * distances + np.asarray(y_offsets)[:, np.newaxis, np.newaxis]
+            vectors[..., 1] = np.cos(rad) * distances + np.asarray(x_offsets)[:, np.newaxis, np.newaxis]
+            return vectors
+
+
     @staticmethod
     def get_offsets(rotation: float, distance: int):
         rad = math.radians(rotation)
@@ -112,6 +446,20 @@ class Vectorizer:
         y = math.cos(rad) * distance
         return round(x), round(y)
     
+    def get_params(self):
+        # Alles, was neben den Quelldateien und dem Seed die Vektoren bestimmt
+        return {
+            "VECTOR_LENGTH": self.VECTOR_LENGTH,
+            "VECTOR_COUNT": self.VECTOR_COUNT,
+            "VECTOR_SPAN_DEGREES": self.VECTOR_SPAN_DEGREES,
+            "ROTATION_OFFSET_DEGREES": self.ROTATION_OFFSET_DEGREES,
+            "X_OFFSET": self.X_OFFSET,
+            "Y_OFFSET": self.Y_OFFSET,
+            "rotation_step": self.rotation_step,
+            "interpolation": self.interpolation,
+            "centered": self.calibrated,
+        }
+
     def get_max_frames(self):
         length = self.timestamps["last_frame"] - self.timestamps["first_frame"]
         return int(length.max())
@@ -0,0 +1,297 @@
+import json
+import re
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+
+import h5py
+import pandas as pd
+
+import calibration
+import data_reader
+
+DATA_FOLDER = Path("data")
+MANIFEST_FILE = DATA_FOLDER / "manifest.json"
+MANIFEST_VERSION = 3
+# Version 1 hatte noch keine Kalibrierung, Version 2 noch nicht den Namen der
+# Spalte mit der Buchstabennummer, sonst ist das Format gleich
+SUPPORTED_VERSIONS = (1, 2, 3)
+# Spalten der Segmente im Manifest zu den Arrays aus data_reader.get_segment_arrays
+SEGMENT_COLUMNS = {
+    "letters": "Buchstabe",
+    "numbers": "Buchstabennr",
+    "start_ms": "start_ms",
+    "end_ms": "end_ms",
+    "first_frame": "first_frame",
+    "last_frame": "last_frame",
+}
+
+TIMESTAMP_SUFFIXES = (".csv", ".xlsx")
+RECORDING_PATTERN = re.compile(r"(?P<subject>sub\d+)_2drt_(?P<take>\d+)_(?P<utterance>[^_]+)_(?P<run>r\d+)")
+
+
+class Recording:
+    name: str
+    subject: str
+    utterance: str
+    run: str
+    h5: Path
+    timestamps: Path
+    frame_count: int
+    segments: pd.DataFrame
+    number_column: str
+    calibration: dict
+
+    def __init__(self, name: str, subject: str, utterance: str, run: str,
+                 h5: Path, timestamps: Path, frame_count: int, segments: pd.DataFrame,
+                 number_column: str = "Buchstabennr", calibration: dict = None) -> None:
+        self.name = name
+        self.subject = subject
+        self.utterance = utterance
+        self.run = run
+        self.h5 = h5
+        self.timestamps = timestamps
+        self.frame_count = frame_count
+        self.segments = segments
+        self.number_column = number_column
+        self.calibration = calibration
+
+
+    def get_timestamps(self, letter: str = None):
+        # Gleiche Tabelle wie data_reader.read_timestamps für die Quelldatei,
+        # samt Name der Nummernspalte, ohne die Quelldatei zu lesen
+        segments = self.segments
+        if letter is not None:
+            segments = segments[segments["Buchstabe"] == letter]
+        arrays = {key: segments[column].to_numpy() for key, column in SEGMENT_COLUMNS.items()}
+        return data_reader.make_timestamps({**arrays, "number_column": self.number_column})
+
+
+    def open_recon(self):
+        return data_reader.ReconHandle(self.h5)
+
+
+    def get_geometry(self):
+        # Argumente für den Vectorizer, leer ohne Kalibrierung
+        if self.calibration is None:
+            return dict()
+        return {
+            "x_offset": self.calibration["x_offset"],
+            "y_offset": self.calibration["y_offset"],
+            "rotation_offset": self.calibration["rotation_offset"],
+        }
+
+
+    def to_dict(self, root: Path):
+        return {
+            "name": self.name,
+            "subject": self.subject,
+            "utterance": self.utterance,
+            "run": self.run,
+            "h5": None if self.h5 is None else self.h5.relative_to(root).as_posix(),
+            "timestamps": self.timestamps.relative_to(root).as_posix(),
+            "frame_count": self.frame_count,
+            "segments": {column: self.segments[column].tolist() for column in self.segments.columns},
+            "number_column": self.number_column,
+            "calibration": self.calibration,
+        }
+
+
+    @classmethod
+    def from_dict(cls, data: dict, root: Path):
+        number_column = data.get("number_column")
+        if number_column is None:
+            # Ältere Manifeste: die CSVs heißen "Buchstabenr.", die Excel-Dateien "Buchstabennr"
+            number_column = "Buchstabenr." if data["timestamps"].endswith(".csv") else "Buchstabennr"
+        return cls(
+            name=data["name"],
+            subject=data["subject"],
+            utterance=data["utterance"],
+            run=data["run"],
+            h5=None if data["h5"] is None else root / data["h5"],
+            timestamps=root / data["timestamps"],
+            frame_count=data["frame_count"],
+            segments=pd.DataFrame(data["segments"]),
+            number_column=number_column,
+            calibration=data.get("calibration"),
+        )
+
+
+class DatasetIndex:
+    root: Path
+    recordings: list[Recording]
+
+    def __init__(self, root: Path, recordings: list[Recording]) -> None:
+        self.root = Path(root)
+        self.recordings = recordings
+
+
+    def query(self, subject: str = None, letter: str = None, run: str = None, available_only: bool = True):
+        recordings = list()
+        for recording in self.recordings:
+            if available_only and recording.h5 is None:
+                continue
+            if subject is not None and recording.subject != subject:
+                continue
+            if run is not None and recording.run != run:
+                continue
+            if letter is not None and not (recording.segments["Buchstabe"] == letter).any():
+                continue
+            recordings.append(recording)
+        return recordings
+
+
+    def get_subjects(self):
+        return sorted({recording.subject for recording in self.recordings})
+
+
+    def save(self, manifest_file: Path = None):
+        if manifest_file is None:
+            manifest_file = self.root / MANIFEST_FILE.name
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "recordings": [recording.to_dict(self.root) for recording in self.recordings],
+        }
+        Path(manifest_file).write_text(json.dumps(manifest, separators=(",", ":")))
+
+
+    @classmethod
+    def load(cls, manifest_file: Path = MANIFEST_FILE):
+        manifest_file = Path(manifest_file)
+        manifest = json.loads(manifest_file.read_text())
+        if manifest.get("version") not in SUPPORTED_VERSIONS:
+            raise ValueError(f"Unsupported manifest version: {manifest.get('version')}")
+
+        root = manifest_file.parent
+        recordings = [Recording.from_dict(data, root) for data in manifest["recordings"]]
+        return cls(root, recordings)
+
+
+def get_index(root: Path = DATA_FOLDER, rebuild: bool = False):
+    manifest_file = Path(root) / MANIFEST_FILE.name
+    if manifest_file.exists() and not rebuild:
+        return DatasetIndex.load(manifest_file)
+
+    index = build_index(root)
+    if manifest_file.exists():
+        # Kalibrierungen sind teuer und bleiben beim Neuaufbau erhalten
+        previous = DatasetIndex.load(manifest_file)
+        __copy_calibrations(previous, index)
+    index.save(manifest_file)
+    return index
+
+
+def calibrate_index(index: DatasetIndex, force: bool = False, workers: int = 1, **kwargs):
+    # Schätzt Ankerpunkt und Rotation jeder Aufnahme mit Recon-Daten und speichert sie im Manifest
+    recordings = [
+        recording for recording in index.query()
+        if force or recording.calibration is None
+    ]
+    estimate = partial(__calibrate_recording, **kwargs)
+    if workers > 1 and len(recordings) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(estimate, [recording.h5 for recording in recordings]))
+    else:
+        results = [estimate(recording.h5) for recording in recordings]
+
+    for recording, result in zip(recordings, results):
+        recording.calibration = result
+    index.save()
+    return recordings
+
+
+def __calibrate_recording(h5: Path, **kwargs):
+    with data_reader.ReconHandle(h5) as frames:
+        return calibration.calibrate(frames, **kwargs)
+
+
+def __copy_calibrations(previous: DatasetIndex, index: DatasetIndex):
+    calibrations = {
+        recording.name: (recording.frame_count, recording.calibration)
+        for recording in previous.recordings
+    }
+    for recording in index.recordings:
+        frame_count, result = calibrations.get(recording.name, (None, None))
+        if result is not None and frame_count == recording.frame_count:
+            recording.calibration = result
+
+
+def build_index(root: Path = DATA_FOLDER):
+    root = Path(root)
+    recon_files = {
+        filepath.name: filepath
+        for filepath in sorted(root.glob("sub*/2drt/recon/*.h5"))
+    }
+
+    recordings = list()
+    for timestamps_folder in sorted(root.glob("sub*/timestamps")):
+        mapping = __read_mapper(timestamps_folder)
+        for filepath in sorted(timestamps_folder.iterdir()):
+            if filepath.suffix not in TIMESTAMP_SUFFIXES or filepath.name == "mapper.csv":
+                continue
+            if RECORDING_PATTERN.search(filepath.name) is None:
+                continue
+            h5_name = mapping.get(filepath.name, __get_h5_name(filepath.name))
+            recordings.append(__make_recording(filepath, recon_files.get(h5_name)))
+
+    return DatasetIndex(root, recordings)
+
+
+def __read_mapper(timestamps_folder: Path):
+    mapper_file = timestamps_folder / "mapper.csv"
+    if not mapper_file.exists():
+        return dict()
+    mapper = data_reader.get_mapper(mapper_file)
+    return dict(zip(mapper["csv"], mapper["h5"]))
+
+
+def __get_h5_name(timestamps_name: str):
+    # "vocals-sub001_2drt_01_vcv1_r2_video.xlsx" und "sub001_2drt_01_vcv1_r2_recon.csv"
+    # gehören beide zu "sub001_2drt_01_vcv1_r2_recon.h5"
+    match = RECORDING_PATTERN.search(timestamps_name)
+    return f"{match.group(0)}_recon.h5"
+
+
+def __make_recording(timestamps_file: Path, h5_file: Path):
+    match = RECORDING_PATTERN.search(timestamps_file.name)
+    if match is None:
+        raise ValueError(f"Can't parse recording name: {timestamps_file.name}")
+
+    frame_count = None
+    if h5_file is not None:
+        # Nur die Metadaten werden gelesen, nicht die Frames
+        with h5py.File(h5_file, "r") as file:
+            frame_count = file["recon"].shape[0]
+
+    arrays = data_reader.get_segment_arrays(data_reader.read_timestamps(timestamps_file))
+    segments = pd.DataFrame({column: arrays[key] for key, column in SEGMENT_COLUMNS.items()})
+
+    return Recording(
+        name=match.group(0),
+        subject=match.group("subject"),
+        utterance=match.group("utterance"),
+        run=match.group("run"),
+        h5=h5_file,
+        timestamps=timestamps_file,
+        frame_count=frame_count,
+        segments=segments,
+        number_column=str(arrays["number_column"]),
+    )
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build the dataset manifest")
+    parser.add_argument("--calibrate", action="store_true", help="estimate the vector geometry of each recording")
+    parser.add_argument("--force", action="store_true", help="calibrate recordings that already have a calibration")
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+
+    index = get_index(rebuild=True)
+    available = index.query()
+    print(f"Indexed {len(index.recordings)} recordings of {len(index.get_subjects())} subjects, "
+          f"{len(available)} with recon data")
+    if args.calibrate:
+        calibrated = calibrate_index(index, args.force, args.workers)
+        print(f"Calibrated {len(calibrated)} recordings")
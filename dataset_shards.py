@@ -0,0 +1,286 @@
+import json
+from pathlib import Path
+
+import h5py
+import numpy as np
+import tensorflow
+
+import data_preparer
+import data_vectorizer
+import instrumentation
+
+SHARDS_FOLDER = Path("shards")
+INDEX_FILE = "shards.json"
+SHARD_SIZE = 8192
+CHUNK_SAMPLES = 64
+COMPRESSION = "gzip"
+# Samples im Mischpuffer von ShardDataset.iter_batches, bei 300 Frames etwa 170 MiB
+SHUFFLE_BUFFER = 1024
+
+
+class ShardWriter:
+    # Hängt Blöcke fester Länge an HDF5-Dateien an und beginnt nach
+    # shard_size Samples eine neue. Im Speicher liegt nur der aktuelle Block.
+
+    folder: Path
+    length: int
+    letters: list[str]
+    shard_size: int
+    shards: list[dict]
+
+    def __init__(self, folder: Path, length: int, letters: list[str], shard_size: int = SHARD_SIZE,
+                 chunk_samples: int = CHUNK_SAMPLES, dtype=np.float32, compression: str = COMPRESSION) -> None:
+        self.folder = Path(folder)
+        self.length = length
+        self.letters = letters
+        self.shard_size = shard_size
+        self.chunk_samples = chunk_samples
+        self.dtype = np.dtype(dtype)
+        self.compression = compression
+        self.shards = list()
+
+        self.folder.mkdir(parents=True, exist_ok=True)
+        # Ein alter Index würde sonst die überschriebenen Shards beschreiben
+        (self.folder / INDEX_FILE).unlink(missing_ok=True)
+        self.__file = None
+        self.__count = 0
+
+
+    def write(self, vectors: np.ndarray, labels: np.ndarray, lengths: np.ndarray, recordings: np.ndarray):
+        start = 0
+        while start < len(vectors):
+            if self.__file is None or self.__count == self.shard_size:
+                self.__open_shard()
+            stop = min(len(vectors), start + self.shard_size - self.__count)
+            end = self.__count + stop - start
+            with instrumentation.stage("shard write", samples=stop - start):
+                for name, values in (("vectors", vectors), ("labels", labels),
+                                     ("lengths", lengths), ("recordings", recordings)):
+                    dataset = self.__file[name]
+                    dataset.resize(end, axis=0)
+                    dataset[self.__count:end] = values[start:stop]
+            self.__count = end
+            self.shards[-1]["samples"] = end
+            start = stop
+
+
+    def close(self, complete: bool = True):
+        # Der Index wird nur für vollständige Builds geschrieben, ohne ihn
+        # hält ShardDataset den Ordner nicht für einen Datensatz
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+        if not complete:
+            return
+        index = {
+            "length": self.length,
+            "letters": self.letters,
+            "dtype": self.dtype.str,
+            "shards": self.shards,
+        }
+        (self.folder / INDEX_FILE).write_text(json.dumps(index, indent=2))
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, *args):
+        self.close(complete=exc_type is None)
+
+
+    def __open_shard(self):
+        if self.__file is not None:
+            self.__file.close()
+        name = f"shard_{len(self.shards):05d}.h5"
+        self.__file = h5py.File(self.folder / name, "w")
+        vector_count = data_vectorizer.Vectorizer.VECTOR_COUNT
+        vector_length = data_vectorizer.Vectorizer.VECTOR_LENGTH
+        self.__file.create_dataset(
+            "vectors", shape=(0, vector_count, vector_length, self.length),
+            maxshape=(None, vector_count, vector_length, self.length), dtype=self.dtype,
+            chunks=(self.chunk_samples, vector_count, vector_length, self.length),
+            compression=self.compression, shuffle=self.compression is not None)
+        for column in ("labels", "lengths", "recordings"):
+            self.__file.create_dataset(column, shape=(0,), maxshape=(None,), dtype=np.int32,
+                                       chunks=(max(self.chunk_samples, 1024),))
+        self.__file.attrs["letters"] = json.dumps(self.letters)
+        self.__count = 0
+        self.shards.append({"file": name, "samples": 0})
+
+
+def build_shards(folder: Path, n_randomizations: int, seed: int, length: int = None,
+                 max_offset = 4, max_rotation = 10, **kwargs):
+    # Geht Aufnahme für Aufnahme und Block für Block durch den Augmentierungsplan,
+    # der Speicherbedarf hängt so nicht von der Größe des Datensatzes ab
+    vectorizers = data_preparer.get_vectorizers()
+    plan = data_preparer.make_augmentation_plan(n_randomizations, seed, max_offset, max_rotation)
+    if length is None:
+        length = data_preparer.get_max_frames()
+    letter_indices = data_preparer.get_letter_indices()
+    chunk_size = data_preparer.RANDOMIZATION_CHUNK_SIZE
+
+    with ShardWriter(folder, length, list(letter_indices), **kwargs) as writer:
+        for idx, vectorizer in enumerate(vectorizers):
+            for start in range(0, n_randomizations, chunk_size):
+                geometries = plan.get_geometries(idx, np.arange(start, min(start + chunk_size, n_randomizations)))
+                vectors, letters = vectorizer.get_planned_vectors(geometries)
+                vectors = [vector[..., :length] for vector in vectors]
+                writer.write(
+                    data_preparer.make_numpy_cnn(vectors, length, writer.dtype),
+                    np.array([letter_indices[letter] for letter in letters], dtype=np.int32),
+                    np.array([vector.shape[-1] for vector in vectors], dtype=np.int32),
+                    np.full(len(vectors), idx, dtype=np.int32),
+                )
+    plan.save(Path(folder) / "plan.npz")
+    return writer.shards
+
+
+class ShardDataset:
+    # Liest die Shards über h5py-Slices, ohne den Datensatz ganz zu laden
+
+    folder: Path
+    length: int
+    letters: list[str]
+
+    def __init__(self, folder: Path = SHARDS_FOLDER) -> None:
+        self.folder = Path(folder)
+        index = json.loads((self.folder / INDEX_FILE).read_text())
+        self.length = index["length"]
+        self.letters = index["letters"]
+        self.__files = [h5py.File(self.folder / shard["file"], "r") for shard in index["shards"]]
+        self.__offsets = np.zeros(len(self.__files) + 1, dtype=np.int64)
+        np.cumsum([shard["samples"] for shard in index["shards"]], out=self.__offsets[1:])
+
+
+    def __len__(self):
+        return int(self.__offsets[-1])
+
+
+    def read(self, start: int, stop: int, column: str = "vectors"):
+        # Zusammenhängender Bereich, auch über Shard-Grenzen hinweg
+        parts = list()
+        shard = int(np.searchsorted(self.__offsets, start, side="right")) - 1
+        while start < stop:
+            shard_stop = min(stop, self.__offsets[shard + 1])
+            offset = self.__offsets[shard]
+            parts.append(self.__files[shard][column][start - offset:shard_stop - offset])
+            start = shard_stop
+            shard += 1
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate(parts)
+
+
+    def get_labels(self):
+        return self.read(0, len(self), "labels")
+
+
+    def get_lengths(self):
+        return self.read(0, len(self), "lengths")
+
+
+    def iter_batches(self, batch_size: int = 32, shuffle: bool = False, seed: int = None,
+                     shuffle_buffer: int = SHUFFLE_BUFFER):
+        # Gelesen werden immer ganze HDF5-Chunks, die h5py am Stück entpackt.
+        # Mit shuffle kommen die Chunks in zufälliger Reihenfolge in einen
+        # Puffer aus mindestens shuffle_buffer Samples, aus dem die Batches
+        # Sample für Sample gemischt gezogen werden.
+        if not shuffle:
+            for start in range(0, len(self), batch_size):
+                stop = min(start + batch_size, len(self))
+                yield self.read(start, stop), self.read(start, stop, "labels")
+            return
+
+        rng = np.random.default_rng(seed)
+        reads = self.__get_chunk_reads()
+        vectors = list()
+        labels = list()
+        pooled = 0
+        for read in rng.permutation(len(reads)):
+            start, stop = reads[read]
+            vectors.append(self.read(start, stop))
+            labels.append(self.read(start, stop, "labels"))
+            pooled += stop - start
+            if pooled < shuffle_buffer + batch_size:
+                continue
+            vectors, labels = np.concatenate(vectors), np.concatenate(labels)
+            order = rng.permutation(len(vectors))
+            full = len(order) - len(order) % batch_size
+            for start in range(0, full, batch_size):
+                batch = np.sort(order[start:start + batch_size])
+                yield vectors[batch], labels[batch]
+            # Der Rest bleibt für die nächsten Chunks im Puffer
+            vectors, labels = [vectors[order[full:]]], [labels[order[full:]]]
+            pooled = len(order) - full
+
+        if pooled:
+            vectors, labels = np.concatenate(vectors), np.concatenate(labels)
+            order = rng.permutation(len(vectors))
+            for start in range(0, len(order), batch_size):
+                batch = np.sort(order[start:start + batch_size])
+                yield vectors[batch], labels[batch]
+
+
+    def make_dataset(self, batch_size: int = 32, cnn: bool = False, shuffle: bool = True,
+                     seed: int = None, prefetch: int = 2, shuffle_buffer: int = SHUFFLE_BUFFER):
+        vector_count = data_vectorizer.Vectorizer.VECTOR_COUNT
+        vector_length = data_vectorizer.Vectorizer.VECTOR_LENGTH
+        length = self.length
+        dtype = self.__files[0]["vectors"].dtype if self.__files else np.float32
+
+        dataset = tensorflow.data.Dataset.from_generator(
+            lambda: self.iter_batches(batch_size, shuffle, seed, shuffle_buffer),
+            output_signature=(
+                tensorflow.TensorSpec((None, vector_count, vector_length, length), dtype),
+                tensorflow.TensorSpec((None,), tensorflow.int32),
+            ))
+
+        def to_model_input(vectors, letters):
+            if not cnn:
+                vectors = tensorflow.reshape(vectors, (-1, vector_count, vector_length*length))
+            return vectors, tensorflow.one_hot(letters, len(self.letters))
+
+        return dataset.map(to_model_input).prefetch(prefetch)
+
+
+    def __get_chunk_reads(self):
+        # (start, stop) jedes Chunks, an den Chunk-Grenzen innerhalb der Shards
+        reads = list()
+        for shard, file in enumerate(self.__files):
+            chunk_samples = file["vectors"].chunks[0]
+            offset, end = int(self.__offsets[shard]), int(self.__offsets[shard + 1])
+            reads.extend((start, min(start + chunk_samples, end)) for start in range(offset, end, chunk_samples))
+        return reads
+
+
+    def close(self):
+        for file in self.__files:
+            file.close()
+        self.__files = list()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Write randomized vectors of all recordings to HDF5 shards")
+    parser.add_argument("--output", type=Path, default=SHARDS_FOLDER)
+    parser.add_argument("--randomizations", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--length", type=int, help="frames per sample, default is the longest segment")
+    parser.add_argument("--shard-size", type=int, default=SHARD_SIZE)
+    parser.add_argument("--max-offset", type=int, default=4)
+    parser.add_argument("--max-rotation", type=float, default=10)
+    args = parser.parse_args()
+
+    shards = build_shards(args.output, args.randomizations, args.seed, args.length,
+                          args.max_offset, args.max_rotation, shard_size=args.shard_size)
+    print(f"Wrote {sum(shard['samples'] for shard in shards)} samples in {len(shards)} shards to {args.output}")
@@ -0,0 +1,109 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+import data_preparer
+import inference
+import instrumentation
+
+COMBINATIONS = ("average", "vote")
+
+
+def extract_features(vectors: list[np.ndarray], lengths: set[int], dtype=np.float32):
+    # Ein zusammenhängendes (Segmente, 7, 20, length) pro vorkommender
+    # Modelllänge, meist haben alle Modelle dieselbe und es gibt nur eins
+    features = dict()
+    for length in sorted(lengths):
+        with instrumentation.stage("features", samples=len(vectors), length=length):
+            features[length] = data_preparer.make_numpy_cnn(
+                [vector[..., :length] for vector in vectors], length, dtype)
+    return features
+
+
+def combine(probabilities: list[np.ndarray], method: str = "average"):
+    if method not in COMBINATIONS:
+        raise ValueError(f"Unknown combination: {method}")
+    stacked = np.stack(probabilities)
+    average = stacked.mean(axis=0)
+    if method == "average":
+        return average
+
+    # Jedes Modell hat eine Stimme, bei Gleichstand entscheidet der Mittelwert
+    votes = np.zeros_like(average)
+    predictions = stacked.argmax(axis=-1)
+    for model_predictions in predictions:
+        votes[np.arange(len(votes)), model_predictions] += 1
+    return votes + average / (len(probabilities) + 1)
+
+
+def get_confusion_matrix(labels: np.ndarray, predictions: np.ndarray, classes: int):
+    # Zeilen sind die echten Buchstaben, Spalten die vorhergesagten
+    return np.bincount(labels * classes + predictions, minlength=classes * classes).reshape((classes, classes))
+
+
+def evaluate(predictors: dict[str, inference.Predictor], vectors: list[np.ndarray], letters: list[str],
+             method: str = "average", workers: int = None):
+    names = list(predictors)
+    letter_order = predictors[names[0]].letters
+    if letter_order is None or any(predictor.letters != letter_order for predictor in predictors.values()):
+        raise ValueError("All models need the same letter order to be compared")
+    letter_indices = {letter: idx for idx, letter in enumerate(letter_order)}
+    labels = np.array([letter_indices[letter] for letter in letters], dtype=np.int64)
+
+    features = extract_features(vectors, {predictor.length for predictor in predictors.values()})
+    # TensorFlow gibt das GIL während der Modellaufrufe frei
+    with ThreadPoolExecutor(max_workers=workers or len(predictors)) as executor:
+        futures = {
+            name: executor.submit(predictor.predict_input, predictor.get_input_view(features[predictor.length]))
+            for name, predictor in predictors.items()
+        }
+        probabilities = {name: future.result() for name, future in futures.items()}
+    probabilities["ensemble"] = combine([probabilities[name] for name in names], method)
+
+    results = dict()
+    for name, model_probabilities in probabilities.items():
+        predictions = model_probabilities.argmax(axis=-1)
+        results[name] = {
+            "accuracy": float((predictions == labels).mean()) if len(labels) else 0.0,
+            "confusion": get_confusion_matrix(labels, predictions, len(letter_order)),
+            "probabilities": model_probabilities,
+        }
+    return results
+
+
+def print_results(results: dict, letters: list[str]):
+    for name, result in results.items():
+        print(f"\n{name}: {result['accuracy']*100:.1f} % correct")
+        print("      " + " ".join(f"{letter:>5}" for letter in letters))
+        for letter, row in zip(letters, result["confusion"]):
+            print(f"{letter:>5} " + " ".join(f"{count:5d}" for count in row))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Evaluate several models and their ensemble on the same features")
+    parser.add_argument("models", nargs="+", help=f"model names in {inference.MODELS_FOLDER} or paths")
+    parser.add_argument("--letters", default="AEO", help="letter order used in training")
+    parser.add_argument("--combine", choices=COMBINATIONS, default="average")
+    parser.add_argument("--randomizations", type=int, help="evaluate on randomized vectors instead of the defaults")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    letters = list(args.letters)
+    predictors = dict()
+    for model in args.models:
+        model_path = Path(model) if Path(model).exists() else inference.MODELS_FOLDER / model
+        predictors[model_path.stem] = inference.Predictor(model_path, letters)
+
+    if args.randomizations is None:
+        vectors, segment_letters = data_preparer.get_default_vectors()
+    else:
+        vectors, segment_letters = data_preparer.get_randomized_vectors(args.randomizations, args.seed)
+    # Nur Segmente mit Buchstaben, die die Modelle kennen
+    known = [idx for idx, letter in enumerate(segment_letters) if letter in letters]
+    vectors = [vectors[idx] for idx in known]
+    segment_letters = [segment_letters[idx] for idx in known]
+
+    print_results(evaluate(predictors, vectors, segment_letters, args.combine), letters)
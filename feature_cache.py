@@ -0,0 +1,106 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+CACHE_FOLDER = Path(".feature_cache")
+MAX_CACHE_BYTES = 2 * 1024**3
+
+
+def file_digest(filepath: Path, digests: dict = None):
+    # Der Hash wird über den Inhalt gebildet, aber pro (Pfad, Größe, Änderungszeit)
+    # nur einmal berechnet, damit große H5-Dateien nicht bei jedem Start gelesen werden
+    filepath = Path(filepath)
+    stat = filepath.stat()
+    memo_key = f"{filepath.resolve()}:{stat.st_size}:{stat.st_mtime_ns}"
+    if digests is not None and memo_key in digests:
+        return digests[memo_key]
+
+    sha = hashlib.sha256()
+    with open(filepath, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            sha.update(block)
+    digest = sha.hexdigest()
+
+    if digests is not None:
+        digests[memo_key] = digest
+    return digest
+
+
+class FeatureCache:
+    directory: Path
+    max_bytes: int
+
+    def __init__(self, directory: Path = CACHE_FOLDER, max_bytes: int = MAX_CACHE_BYTES) -> None:
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        self.__digests_file = self.directory / "digests.json"
+        self.__digests = dict()
+        if self.__digests_file.exists():
+            self.__digests = json.loads(self.__digests_file.read_text())
+
+
+    def get_key(self, source_files: list[Path], params: dict):
+        digests = [file_digest(filepath, self.__digests) for filepath in source_files]
+        self.__digests_file.write_text(json.dumps(self.__digests))
+
+        description = json.dumps({"sources": digests, "params": params}, sort_keys=True, default=str)
+        return hashlib.sha256(description.encode()).hexdigest()
+
+
+    def load(self, key: str):
+        filepath = self.__get_path(key)
+        if not filepath.exists():
+            return None
+
+        with np.load(filepath) as data:
+            values = data["values"]
+            offsets = data["offsets"]
+            letters = data["letters"].tolist()
+        # Zugriffszeit für die LRU-Verdrängung aktualisieren
+        os.utime(filepath)
+
+        vectors = [values[..., start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+        return vectors, letters
+
+
+    def store(self, key: str, vectors: list[np.ndarray], letters: list[str]):
+        lengths = [vector.shape[-1] for vector in vectors]
+        offsets = np.zeros(len(vectors) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        values = np.concatenate(vectors, axis=-1) if vectors else np.empty(0)
+
+        # Erst vollständig schreiben, dann umbenennen, damit abgebrochene
+        # Läufe keine halben Einträge hinterlassen
+        filepath = self.__get_path(key)
+        temp_path = filepath.with_suffix(".tmp.npz")
+        np.savez(temp_path, values=values, offsets=offsets, letters=np.array(letters))
+        os.replace(temp_path, filepath)
+
+        self.evict()
+
+
+    def evict(self):
+        entries = [
+            (filepath.stat().st_mtime, filepath.stat().st_size, filepath)
+            for filepath in self.directory.glob("*.npz")
+        ]
+        total = sum(size for _, size, _ in entries)
+        for _, size, filepath in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            filepath.unlink()
+            total -= size
+
+
+    def clear(self):
+        for filepath in self.directory.glob("*.npz"):
+            filepath.unlink()
+
+
+    def __get_path(self, key: str):
+        return self.directory / f"{key}.npz"
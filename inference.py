@@ -0,0 +1,252 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from pathlib import Path
+
+import numpy as np
+import tensorflow
+
+import data_preparer
+import data_vectorizer
+import instrumentation
+import prediction_cache
+
+MODELS_FOLDER = Path("models")
+
+
+class Predictor:
+    model_path: Path
+    length: int
+    cnn: bool
+    letters: list[str]
+    max_batch_size: int
+    cache: prediction_cache.PredictionCache
+
+    def __init__(self, model_path: Path, letters: list[str] = None, max_batch_size: int = 64,
+                 cache: prediction_cache.PredictionCache = None) -> None:
+        self.model_path = Path(model_path)
+        self.model = tensorflow.keras.models.load_model(self.model_path)
+        self.letters = letters
+        self.max_batch_size = max_batch_size
+        self.cache = cache
+
+        # LSTM-Modelle bekommen (7, 20*length) wie aus make_numpy,
+        # CNN-Modelle (7, 20, length) wie aus make_numpy_cnn, evtl. mit Kanal-Achse
+        input_shape = tuple(self.model.input_shape)
+        vector_length = data_vectorizer.Vectorizer.VECTOR_LENGTH
+        self.cnn = len(input_shape) > 3
+        if self.cnn:
+            self.length = input_shape[3]
+        else:
+            self.length = input_shape[2] // vector_length
+        self.input_shape = input_shape[1:]
+
+        # Feste Signatur, damit wechselnde Batch-Größen nicht neu getraced werden
+        self.__call = tensorflow.function(
+            lambda vectors: self.model(vectors, training=False),
+            input_signature=[tensorflow.TensorSpec((None, *self.input_shape), tensorflow.float32)],
+        )
+        self.warm_up()
+
+
+    def warm_up(self):
+        self.__call(np.zeros((1, *self.input_shape), dtype=np.float32))
+
+
+    def make_input(self, segments: list[np.ndarray]):
+        # Längere Segmente werden auf die Länge aus dem Training gekürzt
+        segments = [segment[..., :self.length] for segment in segments]
+        if self.cnn:
+            vectors = data_preparer.make_numpy_cnn(segments, self.length, np.float32)
+        else:
+            vectors = data_preparer.make_numpy(segments, self.length, np.float32)
+        return vectors.reshape((len(segments), *self.input_shape))
+
+
+    def get_input_view(self, features: np.ndarray):
+        # features ist ein zusammenhängendes (Segmente, 7, 20, length) wie aus
+        # make_numpy_cnn, beide Eingabeformate sind davon nur Views
+        return features.reshape((len(features), *self.input_shape))
+
+
+    def predict_batch(self, segments: list[np.ndarray]):
+        probabilities = list()
+        for start in range(0, len(segments), self.max_batch_size):
+            probabilities.append(self.predict_input(self.make_input(segments[start:start + self.max_batch_size])))
+        if not probabilities:
+            return self.predict_input(np.zeros((0, *self.input_shape), dtype=np.float32))
+        return np.concatenate(probabilities)
+
+
+    def predict_input(self, vectors: np.ndarray):
+        # Fertige Modelleingaben, z.B. aus get_input_view, in Batches von max_batch_size
+        probabilities = list()
+        for start in range(0, len(vectors), self.max_batch_size):
+            batch = vectors[start:start + self.max_batch_size]
+            with instrumentation.stage("model call", samples=len(batch)):
+                probabilities.append(self.__call(batch).numpy())
+        if not probabilities:
+            return np.zeros((0, self.model.output_shape[-1]), dtype=np.float32)
+        return np.concatenate(probabilities)
+
+
+    def predict_letters(self, segments: list[np.ndarray]):
+        if self.letters is None:
+            raise ValueError("Predictor needs the letter order used in training to name predictions")
+        probabilities = self.predict_batch(segments)
+        return [self.letters[idx] for idx in probabilities.argmax(axis=-1)]
+
+
+    def predict_recording(self, vectorizer: data_vectorizer.Vectorizer, recording_path: Path = None):
+        key = None
+        if self.cache is not None:
+            # Bei ndarray-Frames muss die Quelldatei angegeben werden
+            recording_path = recording_path or prediction_cache.get_recording_path(vectorizer)
+            if recording_path is None:
+                raise ValueError("Predictions can only be cached with the path of the recording")
+            key = self.cache.get_recording_key(self.model_path, recording_path, vectorizer,
+                                               {"max_offset": 0, "max_rotation": 0})
+            cached = self.cache.load(key)
+            if cached is not None:
+                instrumentation.count("prediction cache hits")
+                return cached
+
+        # Standard-Geometrie ohne Verschiebung und Rotation, wie get_default_vectors
+        segments, letters = vectorizer.get_randomized_vectors_batch(1, 0, 0)
+        probabilities = self.predict_batch(segments)
+        if key is not None:
+            self.cache.store(key, probabilities, letters)
+        return probabilities, letters
+
+
+class TFLitePredictor(Predictor):
+    # Gleiche Schnittstelle wie Predictor für ein mit model_export erzeugtes
+    # TFLite-Modell. Die Batch-Größe ist beim Export festgelegt, kleinere
+    # Batches werden mit Nullen aufgefüllt.
+
+    def __init__(self, model_path: Path, letters: list[str] = None,
+                 cache: prediction_cache.PredictionCache = None, threads: int = None) -> None:
+        self.model_path = Path(model_path)
+        self.letters = letters
+        self.cache = cache
+
+        self.interpreter = tensorflow.lite.Interpreter(model_path=str(self.model_path), num_threads=threads)
+        self.interpreter.allocate_tensors()
+        self.__input = self.interpreter.get_input_details()[0]
+        self.__output = self.interpreter.get_output_details()[0]
+        input_shape = tuple(int(size) for size in self.__input["shape"])
+        vector_length = data_vectorizer.Vectorizer.VECTOR_LENGTH
+        self.cnn = len(input_shape) > 3
+        if self.cnn:
+            self.length = input_shape[3]
+        else:
+            self.length = input_shape[2] // vector_length
+        self.input_shape = input_shape[1:]
+        self.max_batch_size = input_shape[0]
+        self.output_size = int(self.__output["shape"][-1])
+        self.__batch = np.zeros(input_shape, dtype=np.float32)
+        self.warm_up()
+
+
+    def warm_up(self):
+        self.__invoke(self.__batch[:1])
+
+
+    def predict_input(self, vectors: np.ndarray):
+        probabilities = list()
+        for start in range(0, len(vectors), self.max_batch_size):
+            batch = vectors[start:start + self.max_batch_size]
+            with instrumentation.stage("model call", samples=len(batch)):
+                probabilities.append(self.__invoke(batch))
+        if not probabilities:
+            return np.zeros((0, self.output_size), dtype=np.float32)
+        return np.concatenate(probabilities)
+
+
+    def __invoke(self, vectors: np.ndarray):
+        self.__batch[:len(vectors)] = vectors
+        self.__batch[len(vectors):] = 0
+        self.interpreter.set_tensor(self.__input["index"], self.__batch)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.__output["index"])[:len(vectors)].copy()
+
+
+class MicroBatcher:
+    # Sammelt einzelne Anfragen aus mehreren Threads und schickt sie gemeinsam
+    # durch das Modell, sobald max_batch_size erreicht ist oder die älteste
+    # Anfrage max_latency Sekunden gewartet hat.
+
+    predictor: Predictor
+    max_batch_size: int
+    max_latency: float
+
+    def __init__(self, predictor: Predictor, max_batch_size: int = None, max_latency: float = 0.005) -> None:
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size or predictor.max_batch_size
+        self.max_latency = max_latency
+
+        self.__requests = queue.Queue()
+        self.__worker = threading.Thread(target=self.__run, daemon=True)
+        self.__worker.start()
+
+
+    def submit(self, segment: np.ndarray) -> Future:
+        future = Future()
+        self.__requests.put((segment, future))
+        return future
+
+
+    def predict(self, segment: np.ndarray):
+        return self.submit(segment).result()
+
+
+    def close(self):
+        self.__requests.put(None)
+        self.__worker.join()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def __run(self):
+        closed = False
+        while not closed:
+            request = self.__requests.get()
+            if request is None:
+                break
+
+            batch = [request]
+            deadline = time.monotonic() + self.max_latency
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.__requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if request is None:
+                    closed = True
+                    break
+                batch.append(request)
+
+            segments = [segment for segment, _ in batch]
+            try:
+                probabilities = self.predictor.predict_batch(segments)
+            except Exception as error:
+                for _, future in batch:
+                    future.set_exception(error)
+                continue
+            for (_, future), probability in zip(batch, probabilities):
+                future.set_result(probability)
+
+
+def load_predictor(name: str, letters: list[str] = None, max_batch_size: int = 64,
+                   cache: prediction_cache.PredictionCache = None):
+    return Predictor(MODELS_FOLDER / name, letters, max_batch_size, cache)
@@ -0,0 +1,140 @@
+import atexit
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+
+# MRI_PROFILE=1 schaltet die Messung für den ganzen Prozess ein, die Zusammenfassung
+# wird am Ende ausgegeben. MRI_PROFILE_TRACE=<datei> schreibt zusätzlich einen Chrome-Trace.
+ENV_VARIABLE = "MRI_PROFILE"
+TRACE_ENV_VARIABLE = "MRI_PROFILE_TRACE"
+
+enabled = os.environ.get(ENV_VARIABLE, "") not in ("", "0")
+events: list[tuple] = list()
+counters: dict[str, float] = defaultdict(float)
+__origin = time.perf_counter()
+
+
+class Stage:
+    __slots__ = ("name", "args", "start")
+
+    def __init__(self, name: str, args: dict) -> None:
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        events.append((self.name, self.start, end - self.start, os.getpid(), threading.get_ident(), self.args))
+        return False
+
+
+class NullStage:
+    # Wird bei abgeschalteter Messung zurückgegeben, kostet nur den Funktionsaufruf
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+__null_stage = NullStage()
+
+
+def stage(name: str, **args):
+    if not enabled:
+        return __null_stage
+    return Stage(name, args)
+
+
+def count(name: str, value: float = 1):
+    if enabled:
+        counters[name] += value
+
+
+def reset():
+    events.clear()
+    counters.clear()
+
+
+@contextmanager
+def profiling(trace_file: Path = None, summary: bool = True):
+    global enabled
+    previous = enabled
+    enabled = True
+    reset()
+    try:
+        yield
+    finally:
+        enabled = previous
+        if summary:
+            print_summary()
+        if trace_file is not None:
+            write_chrome_trace(trace_file)
+
+
+def get_summary():
+    durations = defaultdict(list)
+    for name, _, duration, *_ in events:
+        durations[name].append(duration)
+
+    summary = dict()
+    for name, values in durations.items():
+        summary[name] = {
+            "calls": len(values),
+            "total_s": sum(values),
+            "mean_ms": sum(values) / len(values) * 1000,
+            "max_ms": max(values) * 1000,
+        }
+    return summary
+
+
+def print_summary():
+    summary = get_summary()
+    if summary:
+        print(f"{'stage':<24} {'calls':>8} {'total s':>10} {'mean ms':>10} {'max ms':>10}")
+        for name, entry in sorted(summary.items(), key=lambda item: -item[1]["total_s"]):
+            print(f"{name:<24} {entry['calls']:8d} {entry['total_s']:10.3f} "
+                  f"{entry['mean_ms']:10.3f} {entry['max_ms']:10.3f}")
+    for name, value in sorted(counters.items()):
+        print(f"{name:<24} {value:>14.0f}")
+
+
+def write_chrome_trace(trace_file: Path):
+    # Format für chrome://tracing bzw. Perfetto, Zeiten in Mikrosekunden
+    trace_events = [
+        {
+            "name": name,
+            "ph": "X",
+            "ts": (start - __origin) * 1e6,
+            "dur": duration * 1e6,
+            "pid": pid,
+            "tid": tid,
+            "args": args,
+        }
+        for name, start, duration, pid, tid, args in events
+    ]
+    trace_events.extend(
+        {"name": name, "ph": "C", "ts": 0, "pid": os.getpid(), "args": {"value": value}}
+        for name, value in counters.items()
+    )
+    Path(trace_file).write_text(json.dumps({"traceEvents": trace_events}))
+
+
+def __report_at_exit():
+    print_summary()
+    trace_file = os.environ.get(TRACE_ENV_VARIABLE)
+    if trace_file:
+        write_chrome_trace(trace_file)
+
+
+if enabled:
+    atexit.register(__report_at_exit)
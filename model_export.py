@@ -0,0 +1,173 @@
+import time
+from pathlib import Path
+
+import numpy as np
+import tensorflow
+from tensorflow.python.framework.convert_to_constants import convert_variables_to_constants_v2
+
+import data_preparer
+import inference
+
+EXPORT_FOLDER = Path("exported")
+QUANTIZATIONS = (None, "float16", "int8")
+REPRESENTATIVE_SAMPLES = 100
+LATENCY_REPEATS = 200
+
+
+def export_tflite(predictor: inference.Predictor, output_file: Path, quantization: str = None,
+                  representative_segments: list[np.ndarray] = None, batch_size: int = 1):
+    # float16 halbiert die Gewichte, int8 ohne repräsentative Daten quantisiert
+    # nur die Gewichte (Dynamic Range), mit Daten auch die Aktivierungen
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f"Unknown quantization: {quantization}")
+
+    # Eingefrorene Funktion mit fester Batch-Größe, nur so werden die LSTM-
+    # Schleifen in reine TFLite-Operationen übersetzt
+    function = tensorflow.function(
+        lambda vectors: predictor.model(vectors, training=False),
+        input_signature=[tensorflow.TensorSpec((batch_size, *predictor.input_shape), tensorflow.float32)],
+    )
+    frozen = convert_variables_to_constants_v2(function.get_concrete_function(), lower_control_flow=False)
+    converter = tensorflow.lite.TFLiteConverter.from_concrete_functions([frozen])
+    if quantization == "float16":
+        converter.optimizations = [tensorflow.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tensorflow.float16]
+    elif quantization == "int8":
+        converter.optimizations = [tensorflow.lite.Optimize.DEFAULT]
+        if representative_segments is not None:
+            inputs = predictor.make_input(representative_segments[:REPRESENTATIVE_SAMPLES])
+            converter.representative_dataset = lambda: (
+                [__pad_batch(inputs[start:start + batch_size], batch_size)]
+                for start in range(0, len(inputs), batch_size)
+            )
+
+    output_file = Path(output_file)
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    output_file.write_bytes(converter.convert())
+    return output_file
+
+
+def export_variants(predictor: inference.Predictor, folder: Path = EXPORT_FOLDER,
+                    representative_segments: list[np.ndarray] = None, batch_sizes: tuple = None):
+    # Pro Variante ein Modell für einzelne Segmente und eins für volle Batches.
+    # Ohne representative_segments wird int8 nur für die Gewichte verwendet,
+    # die Kalibrierung der Aktivierungen stürzt bei manchen LSTM-Modellen ab.
+    if batch_sizes is None:
+        batch_sizes = (1, predictor.max_batch_size)
+    name = predictor.model_path.stem
+    variants = dict()
+    for quantization in QUANTIZATIONS:
+        suffix = "" if quantization is None else f"_{quantization}"
+        variants[f"tflite{suffix}"] = {
+            batch_size: export_tflite(predictor, Path(folder) / f"{name}{suffix}_b{batch_size}.tflite",
+                                      quantization, representative_segments, batch_size)
+            for batch_size in batch_sizes
+        }
+    return variants
+
+
+def check_parity(reference: np.ndarray, probabilities: np.ndarray, labels: np.ndarray = None):
+    # Vergleich mit den Wahrscheinlichkeiten des Keras-Modells auf denselben Segmenten
+    parity = {
+        "agreement": float((reference.argmax(axis=-1) == probabilities.argmax(axis=-1)).mean()),
+        "max_abs_diff": float(np.abs(reference - probabilities).max()) if len(reference) else 0.0,
+    }
+    if labels is not None:
+        parity["accuracy"] = float((probabilities.argmax(axis=-1) == labels).mean())
+        parity["reference_accuracy"] = float((reference.argmax(axis=-1) == labels).mean())
+    return parity
+
+
+def measure_latency(predictor: inference.Predictor, segments: list[np.ndarray], repeats: int = LATENCY_REPEATS):
+    # Einzelne Segmente wie im Streaming-Betrieb
+    latencies = np.empty(repeats)
+    for idx in range(repeats):
+        segment = segments[idx % len(segments)]
+        start = time.perf_counter()
+        predictor.predict_batch([segment])
+        latencies[idx] = time.perf_counter() - start
+    return {
+        "p50_ms": float(np.percentile(latencies, 50) * 1000),
+        "p99_ms": float(np.percentile(latencies, 99) * 1000),
+    }
+
+
+def measure_throughput(predictor: inference.Predictor, segments: list[np.ndarray], repeats: int = LATENCY_REPEATS):
+    batch_size = predictor.max_batch_size
+    batch = [segments[idx % len(segments)] for idx in range(batch_size)]
+    predictor.predict_batch(batch)
+    rounds = max(1, repeats // batch_size)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        predictor.predict_batch(batch)
+    return {"throughput": rounds * batch_size / (time.perf_counter() - start)}
+
+
+def evaluate_variants(predictor: inference.Predictor, variants: dict, segments: list[np.ndarray],
+                      labels: np.ndarray = None, repeats: int = LATENCY_REPEATS):
+    reference = predictor.predict_batch(segments)
+    report = {"tf.function": {
+        **check_parity(reference, reference, labels),
+        **measure_latency(predictor, segments, repeats),
+        **measure_throughput(predictor, segments, repeats),
+    }}
+    for name, model_files in variants.items():
+        single = inference.TFLitePredictor(model_files[min(model_files)], predictor.letters)
+        batched = inference.TFLitePredictor(model_files[max(model_files)], predictor.letters)
+        report[name] = {
+            "bytes": Path(model_files[min(model_files)]).stat().st_size,
+            **check_parity(reference, batched.predict_batch(segments), labels),
+            **measure_latency(single, segments, repeats),
+            **measure_throughput(batched, segments, repeats),
+        }
+    return report
+
+
+def __pad_batch(vectors: np.ndarray, batch_size: int):
+    padded = np.zeros((batch_size, *vectors.shape[1:]), dtype=vectors.dtype)
+    padded[:len(vectors)] = vectors
+    return padded
+
+
+def print_report(report: dict):
+    print(f"{'variant':<16} {'agree %':>8} {'max diff':>9} {'acc %':>7} {'p50 ms':>8} {'p99 ms':>8} {'samples/s':>10}")
+    for name, entry in report.items():
+        accuracy = entry.get("accuracy")
+        accuracy = f"{accuracy*100:7.1f}" if accuracy is not None else f"{'-':>7}"
+        print(f"{name:<16} {entry['agreement']*100:8.1f} {entry['max_abs_diff']:9.4f} {accuracy} "
+              f"{entry['p50_ms']:8.2f} {entry['p99_ms']:8.2f} {entry['throughput']:10.0f}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Export a model to TFLite variants and compare them on CPU")
+    parser.add_argument("model", help=f"model name in {inference.MODELS_FOLDER} or path")
+    parser.add_argument("--letters", help="letter order used in training, default are all letters sorted")
+    parser.add_argument("--output", type=Path, default=EXPORT_FOLDER)
+    parser.add_argument("--repeats", type=int, default=LATENCY_REPEATS)
+    parser.add_argument("--full-int8", action="store_true", help="also quantize activations, calibrated on the data")
+    parser.add_argument("--subject", help="evaluate on the recordings of this subject from the dataset index "
+                                          "instead of reproducing the unaugmented training recordings")
+    parser.add_argument("--run", help="like --subject, e.g. a run that was held out of training")
+    args = parser.parse_args()
+
+    model_path = Path(args.model)
+    if not model_path.exists():
+        model_path = inference.MODELS_FOLDER / args.model
+    letters = list(args.letters) if args.letters else sorted(data_preparer.get_all_letters())
+    predictor = inference.Predictor(model_path, letters)
+
+    # Ohne Auswahl sind es die Trainingsaufnahmen ohne Verschiebung und Rotation,
+    # das prüft nur die Übereinstimmung der Varianten, nicht die Generalisierung
+    if args.subject is not None or args.run is not None:
+        recordings = data_preparer.select_recordings(subject=args.subject, run=args.run)
+        print(f"Held-out set: {len(recordings)} recordings (subject {args.subject or 'any'}, run {args.run or 'any'})")
+    else:
+        print("Reproduction set: unaugmented training recordings, accuracy is not a held-out score")
+    segments, segment_letters = data_preparer.get_default_vectors()
+    letter_indices = {letter: idx for idx, letter in enumerate(letters)}
+    labels = np.array([letter_indices.get(letter, -1) for letter in segment_letters])
+
+    variants = export_variants(predictor, args.output, segments if args.full_int8 else None)
+    print_report(evaluate_variants(predictor, variants, segments, labels, args.repeats))
@@ -0,0 +1,72 @@
+import os
+from pathlib import Path
+
+import numpy as np
+
+import data_reader
+import data_vectorizer
+import feature_cache
+
+CACHE_FOLDER = Path(".prediction_cache")
+MAX_CACHE_BYTES = 256 * 1024**2
+
+
+def get_model_fingerprint_path(model_path: Path):
+    # SavedModel-Ordner haben eine fingerprint.pb, .keras/.h5-Modelle sind eine einzelne Datei
+    model_path = Path(model_path)
+    if model_path.is_dir():
+        fingerprint_path = model_path / "fingerprint.pb"
+        if fingerprint_path.exists():
+            return fingerprint_path
+        return model_path / "saved_model.pb"
+    return model_path
+
+
+def get_recording_path(vectorizer: data_vectorizer.Vectorizer):
+    if isinstance(vectorizer.frames, data_reader.ReconHandle):
+        return vectorizer.frames.filepath
+    return None
+
+
+class PredictionCache(feature_cache.FeatureCache):
+    # Gleiche Schlüssel und LRU-Verdrängung wie der Feature-Cache, gespeichert
+    # werden aber nur die Wahrscheinlichkeiten pro Segment
+
+    def __init__(self, directory: Path = CACHE_FOLDER, max_bytes: int = MAX_CACHE_BYTES) -> None:
+        super().__init__(directory, max_bytes)
+
+
+    def get_recording_key(self, model_path: Path, recording_path: Path, vectorizer: data_vectorizer.Vectorizer,
+                          params: dict = None):
+        timestamps = vectorizer.timestamps
+        params = {
+            "geometry": vectorizer.get_params(),
+            "segments": [
+                timestamps["first_frame"].tolist(),
+                timestamps["last_frame"].tolist(),
+                timestamps["Buchstabe"].tolist(),
+            ],
+            **(params or dict()),
+        }
+        return self.get_key([get_model_fingerprint_path(model_path), recording_path], params)
+
+
+    def load(self, key: str):
+        filepath = self.directory / f"{key}.npz"
+        if not filepath.exists():
+            return None
+
+        with np.load(filepath) as data:
+            probabilities = data["probabilities"]
+            letters = data["letters"].tolist()
+        os.utime(filepath)
+        return probabilities, letters
+
+
+    def store(self, key: str, probabilities: np.ndarray, letters: list[str]):
+        filepath = self.directory / f"{key}.npz"
+        temp_path = filepath.with_suffix(".tmp.npz")
+        np.savez(temp_path, probabilities=probabilities, letters=np.array(letters))
+        os.replace(temp_path, filepath)
+
+        self.evict()
@@ -0,0 +1,275 @@
+import json
+import signal
+from multiprocessing import resource_tracker, shared_memory
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import data_reader
+import data_vectorizer
+
+DESCRIPTOR_FILE = Path("shared_dataset.json")
+# Felder wie die Arrays aus data_reader.get_segment_arrays
+SEGMENT_DTYPE = np.dtype([
+    ("letters", "U8"),
+    ("numbers", np.int64),
+    ("start_ms", np.int64),
+    ("end_ms", np.int64),
+    ("first_frame", np.int64),
+    ("last_frame", np.int64),
+])
+PUBLISH_CHUNK_FRAMES = 1024
+
+
+class SharedDataset:
+    # Ein Prozess legt die gedrehten Recon-Arrays und Segment-Tabellen aller
+    # Aufnahmen einmal in Shared Memory ab, andere Prozesse hängen sich ohne
+    # Kopie daran. N Worker brauchen so nur einmal den Speicher des Datensatzes.
+
+    descriptor: dict
+    vectorizers: list[data_vectorizer.Vectorizer]
+
+    def __init__(self, descriptor: dict, blocks: list[shared_memory.SharedMemory],
+                 vectorizers: list[data_vectorizer.Vectorizer], owner: bool) -> None:
+        self.descriptor = descriptor
+        self.vectorizers = vectorizers
+        self.__blocks = blocks
+        self.__owner = owner
+
+
+    @property
+    def sources(self):
+        return [
+            None if recording["sources"] is None else tuple(Path(path) for path in recording["sources"])
+            for recording in self.descriptor["recordings"]
+        ]
+
+
+    @property
+    def nbytes(self):
+        return sum(block.size for block in self.__blocks)
+
+
+    def close(self):
+        # Die Arrays der Vectorizer zeigen in die Blöcke und müssen vorher weg
+        self.vectorizers = list()
+        for block in self.__blocks:
+            block.close()
+            if self.__owner:
+                block.unlink()
+        self.__blocks = list()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class SharedFrames:
+    # Frames einer Aufnahme in einem Shared-Memory-Block. Gepickelt, z.B. für
+    # die Worker in data_preparer, werden wie bei ReconHandle nur Name, Form
+    # und Typ des Blocks, der Empfänger hängt sich selbst daran.
+
+    description: dict
+    shape: tuple
+    dtype: np.dtype
+    tracked: bool
+
+    # Jeder Block wird pro Prozess nur einmal angehängt und bleibt es bis zum Ende
+    attached: dict = dict()
+
+    def __init__(self, description: dict, array: np.ndarray, tracked: bool = False) -> None:
+        self.description = description
+        self.shape = array.shape
+        self.dtype = array.dtype
+        # tracked: der Resource-Tracker dieses Prozesses führt den Block, weil
+        # er vom Herausgeber stammt. Kind-Prozesse teilen sich den Tracker.
+        self.tracked = tracked
+        self.__array = array
+
+
+    @property
+    def plane_strides(self):
+        # Gleiches Layout wie data_reader.get_recon
+        return self.shape[-1], 1
+
+
+    def __len__(self):
+        return self.shape[0]
+
+
+    def __getitem__(self, key):
+        return self.__array[key]
+
+
+    def read_planes(self, first_frame: int, last_frame: int):
+        frames = self.__array[first_frame:last_frame]
+        return frames.reshape(len(frames), self.shape[1] * self.shape[2])
+
+
+    def __getstate__(self):
+        return {"description": self.description, "tracked": self.tracked}
+
+
+    def __setstate__(self, state):
+        description = state["description"]
+        if description["name"] not in SharedFrames.attached:
+            # Beim Herausgeber darf die Registrierung nicht entfernt werden,
+            # sonst gibt dessen Tracker den Block nicht mehr frei
+            SharedFrames.attached[description["name"]] = attach_array(description, unregister=not state["tracked"])
+        array, _ = SharedFrames.attached[description["name"]]
+        self.description = description
+        self.shape = array.shape
+        self.dtype = array.dtype
+        self.tracked = state["tracked"]
+        self.__array = array
+
+
+def publish(vectorizers: list[data_vectorizer.Vectorizer], sources: list = None,
+            descriptor_file: Path = None):
+    blocks = list()
+    recordings = list()
+    shared_vectorizers = list()
+    try:
+        for idx, vectorizer in enumerate(vectorizers):
+            frames, frames_block = __publish_frames(vectorizer.frames)
+            segments, segments_block = __publish_segments(vectorizer.timestamps)
+            blocks.extend((frames_block, segments_block))
+
+            recording = {
+                "frames": __describe(frames, frames_block),
+                "segments": __describe(segments, segments_block),
+                "number_column": str(vectorizer.timestamps.columns[1]),
+                "sources": None if sources is None else [str(path) for path in sources[idx]],
+                "geometry": __get_geometry(vectorizer),
+                "seed": vectorizer.seed,
+            }
+            recordings.append(recording)
+            shared_vectorizers.append(data_vectorizer.Vectorizer(
+                SharedFrames(recording["frames"], frames, tracked=True),
+                __make_timestamps(segments, recording["number_column"]),
+                seed=recording["seed"], **recording["geometry"]))
+    except BaseException:
+        for block in blocks:
+            block.close()
+            block.unlink()
+        raise
+
+    descriptor = {"recordings": recordings}
+    if descriptor_file is not None:
+        Path(descriptor_file).write_text(json.dumps(descriptor))
+    return SharedDataset(descriptor, blocks, shared_vectorizers, owner=True)
+
+
+def attach(descriptor):
+    # descriptor ist das Dict aus publish oder der Pfad der JSON-Datei
+    if not isinstance(descriptor, dict):
+        descriptor = json.loads(Path(descriptor).read_text())
+
+    blocks = list()
+    vectorizers = list()
+    try:
+        for recording in descriptor["recordings"]:
+            frames, frames_block = attach_array(recording["frames"])
+            blocks.append(frames_block)
+            segments, segments_block = attach_array(recording["segments"])
+            blocks.append(segments_block)
+            vectorizers.append(data_vectorizer.Vectorizer(
+                SharedFrames(recording["frames"], frames), __make_timestamps(segments, recording["number_column"]),
+                seed=recording["seed"], **recording["geometry"]))
+    except BaseException:
+        for block in blocks:
+            block.close()
+        raise
+    return SharedDataset(descriptor, blocks, vectorizers, owner=False)
+
+
+def __publish_frames(frames):
+    # Gleiches Layout wie data_reader.get_recon, blockweise kopiert, damit
+    # der Herausgeber nie eine zweite ganze Aufnahme im Speicher hält
+    shape = tuple(frames.shape)
+    dtype = np.dtype(frames.dtype)
+    block = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * dtype.itemsize))
+    array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    for first_frame in range(0, shape[0], PUBLISH_CHUNK_FRAMES):
+        array[first_frame:first_frame + PUBLISH_CHUNK_FRAMES] = frames[first_frame:first_frame + PUBLISH_CHUNK_FRAMES]
+    return array, block
+
+
+def __publish_segments(timestamps: pd.DataFrame):
+    block = shared_memory.SharedMemory(create=True, size=max(1, len(timestamps) * SEGMENT_DTYPE.itemsize))
+    segments = np.ndarray((len(timestamps),), dtype=SEGMENT_DTYPE, buffer=block.buf)
+    arrays = data_reader.get_segment_arrays(timestamps)
+    for name in SEGMENT_DTYPE.names:
+        segments[name] = arrays[name]
+    return segments, block
+
+
+def __get_geometry(vectorizer: data_vectorizer.Vectorizer):
+    # Kalibrierte Geometrie und Extraktions-Einstellungen der Quelle,
+    # damit angehängte Prozesse dieselben Vektoren erzeugen. Die Offsets
+    # nur bei kalibrierten Aufnahmen, sonst würde zentriert gezogen.
+    params = vectorizer.get_params()
+    geometry = {
+        "rotation_step": params["rotation_step"],
+        "interpolation": params["interpolation"],
+    }
+    if vectorizer.calibrated:
+        geometry.update({
+            "x_offset": int(params["X_OFFSET"]),
+            "y_offset": int(params["Y_OFFSET"]),
+            "rotation_offset": float(params["ROTATION_OFFSET_DEGREES"]),
+        })
+    return geometry
+
+
+def __describe(array: np.ndarray, block: shared_memory.SharedMemory):
+    return {
+        "name": block.name,
+        "shape": list(array.shape),
+        "dtype": np.lib.format.dtype_to_descr(array.dtype),
+    }
+
+
+def attach_array(description: dict, unregister: bool = True):
+    block = shared_memory.SharedMemory(name=description["name"])
+    # Angehängte Prozesse dürfen den Block beim Beenden nicht freigeben,
+    # das übernimmt der Herausgeber
+    if unregister:
+        resource_tracker.unregister(block._name, "shared_memory")
+    dtype = np.lib.format.descr_to_dtype(description["dtype"])
+    array = np.ndarray(tuple(description["shape"]), dtype=dtype, buffer=block.buf)
+    array.flags.writeable = False
+    return array, block
+
+
+def __make_timestamps(segments: np.ndarray, number_column: str):
+    arrays = {name: segments[name] for name in SEGMENT_DTYPE.names}
+    return data_reader.make_timestamps({**arrays, "number_column": number_column})
+
+
+if __name__ == "__main__":
+    import argparse
+
+    import data_preparer
+
+    parser = argparse.ArgumentParser(description="Publish the recordings of data_preparer in shared memory")
+    parser.add_argument("--descriptor", type=Path, default=DESCRIPTOR_FILE)
+    parser.add_argument("--workers", type=int, default=data_preparer.LOADER_WORKERS,
+                        help="threads that load the recordings before publishing")
+    args = parser.parse_args()
+
+    dataset = data_preparer.publish_shared_dataset(args.descriptor, args.workers)
+    print(f"Published {len(dataset.vectorizers)} recordings ({dataset.nbytes / 1024**2:.1f} MiB) "
+          f"to {args.descriptor}, press Ctrl+C to stop")
+    try:
+        signal.pause()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        dataset.close()
+        args.descriptor.unlink(missing_ok=True)
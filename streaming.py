@@ -0,0 +1,135 @@
+import queue
+import time
+from pathlib import Path
+
+import numpy as np
+
+import data_reader
+import data_vectorizer
+import inference
+
+
+def replay_recon(filepath: Path, frame_rate: float = data_reader.FRAME_RATE, realtime: bool = True,
+                 chunk_size: int = 64):
+    # Spielt eine Aufnahme Frame für Frame ab, auf Wunsch im Takt des Scanners
+    frame_duration = 1 / frame_rate
+    with data_reader.ReconHandle(filepath) as recon:
+        start = time.perf_counter()
+        for first_frame in range(0, len(recon), chunk_size):
+            for offset, frame in enumerate(recon[first_frame:first_frame + chunk_size]):
+                if realtime:
+                    delay = start + (first_frame + offset) * frame_duration - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                yield frame
+
+
+def iter_queue(frames: queue.Queue):
+    # Liest Frames aus einer Queue, bis None kommt
+    while True:
+        frame = frames.get()
+        if frame is None:
+            return
+        yield frame
+
+
+class StreamingRecognizer:
+    predictor: inference.Predictor
+    window: int
+    hop: int
+    latencies: list[float]
+
+    def __init__(self, predictor: inference.Predictor, window: int = None, hop: int = 8,
+                 vector_positions: np.ndarray = None) -> None:
+        self.predictor = predictor
+        self.window = window or predictor.length
+        self.hop = hop
+
+        self.vectorizer = data_vectorizer.Vectorizer(None, None)
+        if vector_positions is None:
+            vectorizer = self.vectorizer
+            vector_positions = vectorizer.get_vectors_positions(
+                [vectorizer.ROTATION_OFFSET_DEGREES], [vectorizer.X_OFFSET], [vectorizer.Y_OFFSET])[0]
+        self.vector_positions = vector_positions
+
+        # Ringpuffer der letzten window Spalten, pro Frame wird nur eine geschrieben
+        shape = (self.vectorizer.VECTOR_COUNT, self.vectorizer.VECTOR_LENGTH, self.window)
+        self.buffer = np.zeros(shape, dtype=np.float32)
+        self.frame_count = 0
+        self.latencies = list()
+
+
+    def reset(self):
+        self.buffer[:] = 0
+        self.frame_count = 0
+        self.latencies = list()
+
+
+    def get_window(self):
+        # Die Spalten in zeitlicher Reihenfolge, die älteste zuerst
+        filled = min(self.frame_count, self.window)
+        position = self.frame_count % self.window
+        if filled < self.window:
+            return self.buffer[..., :filled]
+        return np.concatenate((self.buffer[..., position:], self.buffer[..., :position]), axis=-1)
+
+
+    def process(self, frame: np.ndarray):
+        start = time.perf_counter()
+
+        position = self.frame_count % self.window
+        self.buffer[..., position] = self.vectorizer.get_frame_column(frame, self.vector_positions)
+        self.frame_count += 1
+
+        probabilities = None
+        if self.frame_count % self.hop == 0:
+            probabilities = self.predictor.predict_batch([self.get_window()])[0]
+
+        self.latencies.append(time.perf_counter() - start)
+        return probabilities
+
+
+    def run(self, frames):
+        # Liefert (Frame-Nummer, Wahrscheinlichkeiten, Latenz) für jedes ausgewertete Fenster
+        for frame in frames:
+            probabilities = self.process(frame)
+            if probabilities is not None:
+                yield self.frame_count - 1, probabilities, self.latencies[-1]
+
+
+    def get_latency_report(self, frame_rate: float = data_reader.FRAME_RATE):
+        latencies = np.array(self.latencies)
+        if len(latencies) == 0:
+            return dict()
+        frame_duration = 1 / frame_rate
+        return {
+            "frames": len(latencies),
+            "mean_ms": float(latencies.mean() * 1000),
+            "p50_ms": float(np.percentile(latencies, 50) * 1000),
+            "p99_ms": float(np.percentile(latencies, 99) * 1000),
+            "max_ms": float(latencies.max() * 1000),
+            "frame_budget_ms": frame_duration * 1000,
+            "late_frames": int((latencies > frame_duration).sum()),
+            # Im Mittel schnell genug, wenn die Verarbeitung unter der Frame-Dauer bleibt
+            "keeps_up": bool(latencies.mean() < frame_duration),
+        }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Classify a recon file as a live frame stream")
+    parser.add_argument("recon", type=Path)
+    parser.add_argument("--model", default="small")
+    parser.add_argument("--letters", default="AEO")
+    parser.add_argument("--hop", type=int, default=8)
+    parser.add_argument("--fast", action="store_true", help="don't wait between frames")
+    args = parser.parse_args()
+
+    predictor = inference.load_predictor(args.model, list(args.letters))
+    recognizer = StreamingRecognizer(predictor, hop=args.hop)
+    frames = replay_recon(args.recon, realtime=not args.fast)
+    for frame_idx, probabilities, latency in recognizer.run(frames):
+        letter = predictor.letters[int(probabilities.argmax())]
+        print(f"frame {frame_idx:5d}: {letter} ({probabilities.max()*100:5.1f} %), {latency*1000:.1f} ms")
+    print(recognizer.get_latency_report())
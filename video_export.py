@@ -0,0 +1,147 @@
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import cv2
+import numpy as np
+import pandas as pd
+
+import data_reader
+import data_vectorizer
+import instrumentation
+
+OUTPUT_FOLDER = Path("output")
+CODEC = "mp4v"
+CHUNK_FRAMES = 256
+# BGR, wie cv2 es erwartet
+OVERLAY_COLOR = (0, 0, 255)
+
+
+def normalize_frames(frames: np.ndarray, value_range: tuple = None, out: np.ndarray = None):
+    # Streckt jeden Frame auf 0..255 wie np.interp in other_data_preparer.plot_video,
+    # aber für alle Frames in einem Durchlauf. Mit value_range gilt ein fester Bereich.
+    frames = np.asarray(frames, dtype=np.float64)
+    if value_range is None:
+        low = frames.min(axis=(1, 2), keepdims=True)
+        span = frames.max(axis=(1, 2), keepdims=True) - low
+    else:
+        low = np.float64(value_range[0])
+        span = np.float64(value_range[1]) - low
+    scale = np.divide(255, span, out=np.zeros_like(span), where=span > 0)
+    if out is None:
+        out = np.empty(frames.shape, dtype=np.uint8)
+    # Abschneiden statt Runden, wie der int16-Cast im alten Code
+    np.multiply(frames - low, scale, out=out, casting="unsafe")
+    return out
+
+
+def get_value_range(frames, first_frame: int = 0, last_frame: int = None, chunk_frames: int = CHUNK_FRAMES):
+    # Minimum und Maximum über alle Frames, blockweise gelesen
+    if last_frame is None:
+        last_frame = len(frames)
+    low = np.inf
+    high = -np.inf
+    for start in range(first_frame, last_frame, chunk_frames):
+        chunk = frames[start:min(start + chunk_frames, last_frame)]
+        low = min(low, float(chunk.min()))
+        high = max(high, float(chunk.max()))
+    return low, high
+
+
+def get_overlay_mask(vectorizer: data_vectorizer.Vectorizer, vector_positions: np.ndarray = None):
+    # Pixel des Vektor-Fächers, Standard ist die Geometrie ohne Verschiebung und Rotation
+    if vector_positions is None:
+        vector_positions = vectorizer.get_vectors_positions(
+            [vectorizer.ROTATION_OFFSET_DEGREES], [vectorizer.X_OFFSET], [vectorizer.Y_OFFSET])[0]
+    return vectorizer.get_mask(vector_positions) == 0
+
+
+def write_video(frames, savefile: Path, first_frame: int = 0, last_frame: int = None,
+                frame_rate: float = data_reader.FRAME_RATE, overlay: np.ndarray = None,
+                per_frame: bool = True, codec: str = CODEC, chunk_frames: int = CHUNK_FRAMES):
+    # frames im Layout von data_reader.get_recon, also ndarray oder ReconHandle.
+    # Es werden immer nur chunk_frames Frames gelesen und umgewandelt.
+    if last_frame is None:
+        last_frame = len(frames)
+    last_frame = min(last_frame, len(frames))
+    _, height, width = frames.shape
+
+    savefile = Path(savefile)
+    savefile.parent.mkdir(parents=True, exist_ok=True)
+    writer = cv2.VideoWriter(str(savefile), cv2.VideoWriter_fourcc(*codec), frame_rate, (width, height))
+    if not writer.isOpened():
+        raise OSError(f"Could not open video writer for {savefile} with codec {codec}")
+
+    value_range = None
+    if not per_frame:
+        value_range = get_value_range(frames, first_frame, last_frame, chunk_frames)
+
+    gray = np.empty((chunk_frames, height, width), dtype=np.uint8)
+    color = np.empty((chunk_frames, height, width, 3), dtype=np.uint8)
+    try:
+        for start in range(first_frame, last_frame, chunk_frames):
+            stop = min(start + chunk_frames, last_frame)
+            count = stop - start
+            with instrumentation.stage("video normalize", frames=count):
+                normalize_frames(frames[start:stop], value_range, out=gray[:count])
+                color[:count] = gray[:count, ..., np.newaxis]
+                if overlay is not None:
+                    color[:count, overlay] = OVERLAY_COLOR
+            with instrumentation.stage("video encode", frames=count):
+                for frame in color[:count]:
+                    writer.write(frame)
+    finally:
+        writer.release()
+    return savefile
+
+
+def export_recording(vectorizer: data_vectorizer.Vectorizer, savefolder: Path, name: str,
+                     segments_only: bool = False, overlay: bool = False, **kwargs):
+    mask = get_overlay_mask(vectorizer) if overlay else None
+    if not segments_only:
+        return [write_video(vectorizer.frames, Path(savefolder) / f"{name}.mp4", overlay=mask, **kwargs)]
+
+    savefiles = list()
+    for idx, row in vectorizer.timestamps.reset_index(drop=True).iterrows():
+        if pd.isna(row["first_frame"]) or pd.isna(row["last_frame"]):
+            continue
+        savefile = Path(savefolder) / f"{name}_{idx:03d}_{row['Buchstabe']}.mp4"
+        # last_frame gehört wie in get_pixel_data nicht mehr zum Segment
+        savefiles.append(write_video(vectorizer.frames, savefile, int(row["first_frame"]),
+                                     int(row["last_frame"]), overlay=mask, **kwargs))
+    return savefiles
+
+
+def export_all(savefolder: Path = OUTPUT_FOLDER, segments_only: bool = False, overlay: bool = False,
+               workers: int = 1, **kwargs):
+    # Jede Aufnahme aus mapper.csv wird in einem eigenen Prozess exportiert
+    rows = [row for _, row in data_reader.get_mapper().iterrows()]
+    tasks = [(row["h5"], row["csv"], savefolder, segments_only, overlay, kwargs) for row in rows]
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(__export_row, *zip(*tasks)))
+    else:
+        results = [__export_row(*task) for task in tasks]
+    return [savefile for savefiles in results for savefile in savefiles]
+
+
+def __export_row(h5: str, csv: str, savefolder: Path, segments_only: bool, overlay: bool, kwargs: dict):
+    with data_reader.open_recon(h5) as frames:
+        vectorizer = data_vectorizer.Vectorizer(frames, data_reader.get_timestamps(csv))
+        return export_recording(vectorizer, savefolder, Path(h5).stem, segments_only, overlay, **kwargs)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Export the recordings from mapper.csv as videos for inspection")
+    parser.add_argument("--output", type=Path, default=OUTPUT_FOLDER)
+    parser.add_argument("--segments", action="store_true", help="one video per labelled segment")
+    parser.add_argument("--overlay", action="store_true", help="draw the vector fan over the frames")
+    parser.add_argument("--global-range", action="store_true", help="normalize over the whole recording")
+    parser.add_argument("--codec", default=CODEC)
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+
+    savefiles = export_all(args.output, args.segments, args.overlay, args.workers,
+                           per_frame=not args.global_range, codec=args.codec)
+    print(f"Wrote {len(savefiles)} videos to {args.output}")